@@ -11,37 +11,68 @@ Bazarino Telegram Bot – Optimized Version
 
 from __future__ import annotations
 import asyncio
+import atexit
+import bisect
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dt
-import json
+import functools
+import html
+import itertools
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import os
+import pickle
+import queue
+import re
+import sys
+import threading
+import time
+from urllib.parse import quote
 import uuid
+from dataclasses import dataclass
 import yaml
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 import io
 import random
+import sqlite3
 
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import orjson
+from redis import asyncio as aioredis
+from rapidfuzz import fuzz, process
+from google.auth.transport.requests import AuthorizedSession, Request as GoogleRequest
+import httpx
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from fastapi import FastAPI, Request, HTTPException
 import uvicorn
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram import BotCommand, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, Update
 from telegram.ext import (
-    Application, ApplicationBuilder, CallbackQueryHandler, CommandHandler, ContextTypes,
-    ConversationHandler, MessageHandler, filters, JobQueue
+    AIORateLimiter, Application, ApplicationBuilder, BasePersistence, BaseUpdateProcessor,
+    CallbackQueryHandler, CommandHandler, ContextTypes, ConversationHandler, MessageHandler,
+    PersistenceInput, PicklePersistence, TypeHandler, filters
 )
+from telegram.request import HTTPXRequest
 from telegram.error import BadRequest, NetworkError
 
-# Logging setup
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-    handlers=[
-        logging.StreamHandler(),
-        RotatingFileHandler("bazarino.log", maxBytes=5*1024*1024, backupCount=3)
-    ]
-)
+# Logging setup: handlers only enqueue records; a listener thread does the stderr/file writes
+# (and log rotation), so logging never blocks the event loop
+_log_format = logging.Formatter("%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+_log_handlers = [
+    logging.StreamHandler(),
+    RotatingFileHandler("bazarino.log", maxBytes=5*1024*1024, backupCount=3)
+]
+for _h in _log_handlers:
+    _h.setFormatter(_log_format)
+LOG_QUEUE = queue.SimpleQueue()
+_queue_handler = QueueHandler(LOG_QUEUE)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))    # the listener's handlers add the prefix
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+LOG_LISTENER = QueueListener(LOG_QUEUE, *_log_handlers)
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
 log = logging.getLogger("bazarino")
 
 # Global variables
@@ -49,7 +80,8 @@ tg_app = None
 bot = None
 
 # ───────────── Lazy-import Pillow
-async def generate_invoice(order_id, user_data, cart, total, discount):
+# Drawing and PNG-encoding is pure CPU work; callers run it via asyncio.to_thread
+def generate_invoice(order_id, form, dest, cart, total, discount):
     from PIL import Image, ImageDraw, ImageFont
     width, height = 600, 900
     img = Image.new("RGB", (width, height), color=(255, 255, 255))
@@ -82,18 +114,18 @@ async def generate_invoice(order_id, user_data, cart, total, discount):
     y = 100
     draw.text((50, y), f"شماره سفارش / Ordine #{order_id}", font=body_font, fill=text_color)
     y += 30
-    draw.text((50, y), f"نام / Nome: {user_data['name']}", font=body_font, fill=text_color)
+    draw.text((50, y), f"نام / Nome: {form.name}", font=body_font, fill=text_color)
     y += 30
-    draw.text((50, y), f"مقصد / Destinazione: {user_data['dest']}", font=body_font, fill=text_color)
+    draw.text((50, y), f"مقصد / Destinazione: {dest}", font=body_font, fill=text_color)
     y += 30
-    draw.text((50, y), f"آدرس / Indirizzo: {user_data['address']} | {user_data['postal']}", font=body_font, fill=text_color)
+    draw.text((50, y), f"آدرس / Indirizzo: {form.address} | {form.postal}", font=body_font, fill=text_color)
     y += 40
 
     draw.text((50, y), "محصولات / Prodotti:", font=body_font, fill=text_color)
     y += 30
     draw.rectangle([(40, y - 10), (width - 40, y + 10 + len(cart) * 30)], outline=border_color, width=1)
-    for item in cart:
-        draw.text((50, y), f"{item['qty']}× {item['fa']} — {item['qty'] * item['price']:.2f}€", font=body_font, fill=text_color)
+    for item in cart.values():
+        draw.text((50, y), f"{item.qty}× {item.fa} — {item.qty * item.price:.2f}€", font=body_font, fill=text_color)
         y += 30
     y += 20
 
@@ -101,15 +133,11 @@ async def generate_invoice(order_id, user_data, cart, total, discount):
     y += 30
     draw.text((50, y), f"مجموع / Totale: {total:.2f}€", font=body_font, fill=text_color)
     y += 30
-    draw.text((50, y), f"یادداشت / Nota: {user_data.get('notes', 'بدون یادداشت')}", font=body_font, fill=text_color)
+    draw.text((50, y), f"یادداشت / Nota: {form.notes or 'بدون یادداشت'}", font=body_font, fill=text_color)
     y += 40
 
     draw.rectangle([(40, y - 10), (width - 40, y + 80)], outline=border_color, width=1, fill=beige)
-    if not HAFEZ_QUOTES:
-        log.error("No Hafez quotes defined in config.yaml")
-        hafez = {"fa": "بدون نقل‌قول", "it": "Nessuna citazione"}
-    else:
-        hafez = random.choice(HAFEZ_QUOTES)
+    hafez = next(HAFEZ_CYCLE)
     draw.text((50, y), "✨ فال حافظ / Fal di Hafez:", font=small_font, fill=text_color)
     y += 20
     draw.text((50, y), hafez["fa"], font=small_font, fill=text_color)
@@ -138,26 +166,51 @@ except FileNotFoundError:
 
 SHEET_CONFIG = CONFIG["sheets"]
 HAFEZ_QUOTES = CONFIG["hafez_quotes"]
+if not HAFEZ_QUOTES:
+    log.error("No Hafez quotes defined in config.yaml")
+# Shuffled once and then cycled, so every quote appears before any repeats
+HAFEZ_CYCLE = itertools.cycle(random.sample(HAFEZ_QUOTES, len(HAFEZ_QUOTES)) or
+                              [{"fa": "بدون نقل‌قول", "it": "Nessuna citazione"}])
 required_sheets = ["orders", "products", "abandoned_carts", "discounts", "uploads"]
 for sheet in required_sheets:
     if sheet not in SHEET_CONFIG or "name" not in SHEET_CONFIG[sheet]:
         log.error(f"Missing or invalid sheet configuration for '{sheet}' in config.yaml")
         raise SystemExit(f"❗️ تنظیمات sheet '{sheet}' در config.yaml نامعتبر است.")
 
+# Product rows are read by position (config.yaml columns are 1-based), not by header name
+PRODUCT_COLS = {k: v - 1 for k, v in SHEET_CONFIG["products"].get("columns", {}).items()}
+required_cols = ["id", "cat", "fa", "it", "brand", "description", "weight", "price", "stock"]
+missing_cols = [col for col in required_cols if col not in PRODUCT_COLS]
+if missing_cols:
+    log.error(f"Missing required product columns in config.yaml: {missing_cols}")
+    raise SystemExit(f"❗️ ستون‌های مورد نیاز محصولات در config.yaml تعریف نشده‌اند: {missing_cols}")
+PRODUCT_WIDTH = max(PRODUCT_COLS.values()) + 1
+PRODUCT_RANGE = f"A2:{gspread.utils.rowcol_to_a1(1, PRODUCT_WIDTH)[:-1]}"
+
 # ───────────── Messages
 try:
-    with open("messages.json", encoding="utf-8") as f:
-        MSG = json.load(f)
+    with open("messages.json", "rb") as f:
+        MSG = orjson.loads(f.read())
 except FileNotFoundError:
     log.error("messages.json not found")
     raise SystemExit("❗️ فایل messages.json یافت نشد.")
-except json.JSONDecodeError as e:
+except orjson.JSONDecodeError as e:
     log.error(f"Invalid messages.json: {e}")
     raise SystemExit("❗️ فایل messages.json نامعتبر است: خطا در تجزیه JSON")
 
 def m(k: str) -> str:
     return MSG.get(k, f"[{k}]")
 
+# Static texts resolved once; messages.json marks bold as **...**, which HTML parse mode doesn't understand
+def m_html(k: str) -> str:
+    return re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", html.escape(m(k), quote=False))
+
+WELCOME_HTML = m_html("WELCOME")
+SUPPORT_HTML = m_html("SUPPORT_MESSAGE")
+CART_GUIDE_HTML = m_html("CART_GUIDE") + "\n\n"    # the cart listing from fmt_cart follows
+ABOUT_TEXT = m("ABOUT_US")
+PRIVACY_TEXT = m("PRIVACY")
+
 # ───────────── ENV
 for v in ("TELEGRAM_TOKEN", "ADMIN_CHAT_ID", "BASE_URL"):
     if not os.getenv(v):
@@ -180,76 +233,203 @@ TOKEN = os.getenv("TELEGRAM_TOKEN")
 BASE_URL = os.getenv("BASE_URL").rstrip("/")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "EhsaNegar1394")
 SPREADSHEET = os.getenv("SPREADSHEET_NAME", "Bazarnio Orders")
+# Opening by ID skips the Drive search that opening by name needs
+SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 PRODUCT_WS = os.getenv("PRODUCT_WORKSHEET", "Sheet2")
 PORT = int(os.getenv("PORT", "8000"))
+# TLS is terminated by the platform's proxy; with a proxy on the same host, HOST=127.0.0.1 keeps the
+# plaintext port private
+HOST = os.getenv("HOST", "0.0.0.0")
+# uvicorn closes idle connections after 5s; the proxy in front reuses them across webhook bursts instead
+KEEPALIVE = int(os.getenv("KEEPALIVE_TIMEOUT", "75"))
+
+# /tmp is wiped on every redeploy; state that should outlive a deploy needs a path on a mounted disk
+def on_ephemeral_disk(path: str) -> bool:
+    return os.path.abspath(path).startswith(("/tmp/", "/var/tmp/"))
 
 # ───────────── Google Sheets
+# Drive access is only needed to look the spreadsheet up by name
+scope = ["https://www.googleapis.com/auth/spreadsheets"] + ([] if SPREADSHEET_ID else ["https://www.googleapis.com/auth/drive"])
+creds_path = os.getenv("GOOGLE_CREDS", "/etc/secrets/bazarino-perugia-bot-f37c44dd9b14.json")
+
+def load_credentials(path):
+    # The key file is read once; afterwards tokens are signed from the in-memory key, and the
+    # parsed JSON (private key included) is not kept around at module level
+    with open(path, "rb") as f:
+        info = orjson.loads(f.read())
+    # Self-signed JWTs are minted locally, so token refresh never waits on oauth2.googleapis.com
+    return Credentials.from_service_account_info(info, scopes=scope).with_always_use_jwt_access(True)
+
 try:
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds_path = os.getenv("GOOGLE_CREDS", "/etc/secrets/bazarino-perugia-bot-f37c44dd9b14.json")
-    try:
-        with open(creds_path, "r", encoding="utf-8") as f:
-            CREDS_JSON = json.load(f)
-    except FileNotFoundError:
-        log.error(f"Credentials file '{creds_path}' not found")
-        raise SystemExit(f"❗️ فایل احراز هویت '{creds_path}' یافت نشد.")
-    except json.JSONDecodeError as e:
-        log.error(f"Failed to parse credentials file '{creds_path}': {e}")
-        raise SystemExit(f"❗️ خطا در تجزیه فایل احراز هویت '{creds_path}': {e}")
-    gc = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_dict(CREDS_JSON, scope))
+    CREDS = load_credentials(creds_path)
+except FileNotFoundError:
+    log.error(f"Credentials file '{creds_path}' not found")
+    raise SystemExit(f"❗️ فایل احراز هویت '{creds_path}' یافت نشد.")
+except (orjson.JSONDecodeError, ValueError) as e:
+    log.error(f"Failed to parse credentials file '{creds_path}': {e}")
+    raise SystemExit(f"❗️ خطا در تجزیه فایل احراز هویت '{creds_path}': {e}")
+
+SHEETS_TIMEOUT = 30
+
+# Sheets I/O gets its own small pool: Google serialises writes per project anyway, and this
+# keeps it from starving, or being starved by, other work on the default executor.
+# Four workers so the discount lookup at checkout isn't queued behind backup/status jobs
+SHEETS_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="gspread")
+
+def run_sheets(fn, *args, **kwargs):
+    return asyncio.get_running_loop().run_in_executor(SHEETS_POOL, functools.partial(fn, *args, **kwargs))
+
+# The spreadsheet is opened on first use from a worker thread; failures are not cached.
+# _sheets_lock makes concurrent first calls from SHEETS_POOL wait for one open instead of each
+# opening the spreadsheet and racing on add_worksheet for missing tabs
+_sheets_lock = threading.Lock()
+
+def _sheets() -> Dict[str, gspread.Worksheet]:
+    with _sheets_lock:
+        return _open_sheets()
+
+@functools.lru_cache(maxsize=1)
+def _open_sheets() -> Dict[str, gspread.Worksheet]:
     try:
-        wb = gc.open(SPREADSHEET)
+        # One keep-alive pool shared by every worker thread that talks to Sheets. Quota (429) and
+        # transient 5xx answers are retried with backoff, for idempotent methods only (no POST)
+        session = AuthorizedSession(CREDS)
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+        gc = gspread.Client(auth=CREDS, session=session)
+        gc.set_timeout(SHEETS_TIMEOUT)
+        wb = gc.open_by_key(SPREADSHEET_ID) if SPREADSHEET_ID else gc.open(SPREADSHEET)
     except gspread.exceptions.SpreadsheetNotFound:
-        log.error(f"Spreadsheet '{SPREADSHEET}' not found. Please check the SPREADSHEET_NAME and access permissions.")
-        raise SystemExit(f"❗️ فایل Google Spreadsheet با نام '{SPREADSHEET}' یافت نشد.")
-    try:
-        orders_ws = wb.worksheet(SHEET_CONFIG["orders"]["name"])
-        products_ws = wb.worksheet(SHEET_CONFIG["products"]["name"])
-    except gspread.exceptions.WorksheetNotFound as e:
-        log.error(f"Worksheet not found: {e}. Check config.yaml for correct worksheet names.")
-        raise SystemExit(f"❗️ خطا در دسترسی به worksheet: {e}")
-    try:
-        abandoned_cart_ws = wb.worksheet(SHEET_CONFIG["abandoned_carts"]["name"])
-    except gspread.exceptions.WorksheetNotFound:
-        abandoned_cart_ws = wb.add_worksheet(title=SHEET_CONFIG["abandoned_carts"]["name"], rows=1000, cols=3)
-    try:
-        discounts_ws = wb.worksheet(SHEET_CONFIG["discounts"]["name"])
-    except gspread.exceptions.WorksheetNotFound:
-        discounts_ws = wb.add_worksheet(title=SHEET_CONFIG["discounts"]["name"], rows=1000, cols=4)
-    try:
-        uploads_ws = wb.worksheet(SHEET_CONFIG["uploads"]["name"])
-    except gspread.exceptions.WorksheetNotFound:
-        uploads_ws = wb.add_worksheet(title=SHEET_CONFIG["uploads"]["name"], rows=1000, cols=4)
-except Exception as e:
-    log.error(f"Failed to initialize Google Sheets: {e}")
-    raise SystemExit(f"❗️ خطا در اتصال به Google Sheets: {e}")
+        log.error(f"Spreadsheet '{SPREADSHEET_ID or SPREADSHEET}' not found. Please check SPREADSHEET_ID/SPREADSHEET_NAME and access permissions.")
+        raise RuntimeError(f"Spreadsheet '{SPREADSHEET_ID or SPREADSHEET}' not found")
+    # One metadata fetch for every worksheet instead of a round-trip per wb.worksheet() call
+    worksheets = {ws.title: ws for ws in wb.worksheets()}
+    for key in ("orders", "products"):
+        if SHEET_CONFIG[key]["name"] not in worksheets:
+            log.error(f"Worksheet not found: {SHEET_CONFIG[key]['name']}. Check config.yaml for correct worksheet names.")
+            raise RuntimeError(f"Worksheet not found: {SHEET_CONFIG[key]['name']}")
+    sheets = {key: worksheets[SHEET_CONFIG[key]["name"]] for key in ("orders", "products")}
+    for key, cols in (("abandoned_carts", 3), ("discounts", 4), ("uploads", 4)):
+        name = SHEET_CONFIG[key]["name"]
+        sheets[key] = worksheets.get(name) or wb.add_worksheet(title=name, rows=1000, cols=cols)
+    log.info(f"Connected to Google Spreadsheet '{wb.title}'")
+    return sheets
+
+# Method lookups resolve the real worksheet only when called, so
+# run_sheets(orders_ws.append_rows, ...) connects inside the worker thread
+class LazySheet:
+    def __init__(self, key):
+        self.key = key
+        self.title = SHEET_CONFIG[key]["name"]
+
+    def __getattr__(self, name):
+        return lambda *a, **k: getattr(_sheets()[self.key], name)(*a, **k)
+
+orders_ws = LazySheet("orders")
+products_ws = LazySheet("products")
+abandoned_cart_ws = LazySheet("abandoned_carts")
+discounts_ws = LazySheet("discounts")
+uploads_ws = LazySheet("uploads")
+
+# Reads, appends and cell updates go straight to the Sheets REST API from the event loop;
+# gspread is left for the occasional admin job (status checks, backups, cart reminders)
+SHEETS_API = "https://sheets.googleapis.com/v4/spreadsheets"
+# Only failed connects are retried here: a request that reached Google may already have been applied
+SHEETS_HTTP = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(http2=True, retries=2, limits=httpx.Limits(max_keepalive_connections=8)),
+    timeout=SHEETS_TIMEOUT)
+
+async def sheets_target(key):
+    if SPREADSHEET_ID:
+        # ID and tab name are both known up front; no gspread metadata fetch needed
+        return SPREADSHEET_ID, SHEET_CONFIG[key]["name"]
+    # Only the first open needs a thread; afterwards _sheets() is an lru_cache hit
+    if not _open_sheets.cache_info().currsize:
+        await run_sheets(_sheets)
+    ws = _sheets()[key]
+    return ws.spreadsheet_id, ws.title
+
+# A1 sheet names are single-quoted; an apostrophe inside the title is written twice
+def a1_tab(title: str) -> str:
+    return "'" + title.replace("'", "''") + "'"
+
+async def sheets_call(method, key, path, **kwargs):
+    sheet_id, title = await sheets_target(key)
+    if not CREDS.valid:
+        CREDS.refresh(GoogleRequest())    # local JWT signing, no network
+    if "json" in kwargs:
+        kwargs["content"] = orjson.dumps(kwargs.pop("json"))
+    url = f"{SHEETS_API}/{sheet_id}/values" + path.format(tab=quote(a1_tab(title), safe=""))
+    resp = await SHEETS_HTTP.request(
+        method, url, headers={"Authorization": f"Bearer {CREDS.token}", "Content-Type": "application/json"},
+        **kwargs)
+    resp.raise_for_status()
+    return orjson.loads(resp.content)
+
+async def sheets_get(key, rng, value_render_option="UNFORMATTED_VALUE"):
+    res = await sheets_call("GET", key, f"/{{tab}}{quote('!' + rng, safe='')}",
+                            params={"valueRenderOption": value_render_option})
+    return res.get("values", [])
+
+async def sheets_append(key, rows, value_input_option="RAW"):
+    await sheets_call("POST", key, f"/{{tab}}{quote('!A1', safe='')}:append",
+                      params={"valueInputOption": value_input_option, "insertDataOption": "INSERT_ROWS"},
+                      json={"values": rows})
+
+async def sheets_clear(key):
+    await sheets_call("POST", key, "/{tab}:clear")
+
+# cells: {A1 cell: value}; all cells are written in a single batchUpdate
+async def sheets_update(key, cells, value_input_option="RAW"):
+    _, title = await sheets_target(key)
+    await sheets_call("POST", key, ":batchUpdate", json={
+        "valueInputOption": value_input_option,
+        "data": [{"range": f"{a1_tab(title)}!{a1}", "values": [[v]]} for a1, v in cells.items()],
+    })
 
 # ───────────── Google Sheets Data
-async def load_products() -> Dict[str, Dict[str, Any]]:
+# One catalogue row; slotted, so handlers read fields as attributes instead of dict lookups.
+# Not frozen: stock is decremented in place after each order
+@dataclass(slots=True)
+class Product:
+    cat: str
+    fa: str
+    it: str
+    brand: str
+    desc: str
+    weight: str
+    price: float
+    image_url: str | None
+    stock: int
+    is_bestseller: bool
+    version: str
+
+async def load_products() -> Dict[str, Product]:
     try:
-        records = await asyncio.to_thread(products_ws.get_all_records)
-        required_cols = ["id", "cat", "fa", "it", "brand", "description", "weight", "price"]
-        if records and not all(col in records[0] for col in required_cols):
-            missing = [col for col in required_cols if col not in records[0]]
-            log.error(f"Missing required columns in products worksheet: {missing}")
-            raise SystemExit(f"❗️ ستون‌های مورد نیاز در worksheet محصولات وجود ندارند: {missing}")
+        rows = await sheets_get("products", PRODUCT_RANGE)
+        c = PRODUCT_COLS
+        col = lambda r, k, d="": r[c[k]] if k in c else d
         products = {}
-        for r in records:
+        for r in rows:
+            # The API trims trailing empty cells, so pad short rows
+            r = r + [""] * (PRODUCT_WIDTH - len(r))
+            if r[c["id"]] == "":
+                continue
             try:
-                products[r["id"]] = dict(
-                    cat=r["cat"],
-                    fa=r["fa"],
-                    it=r["it"],
-                    brand=r["brand"],
-                    desc=r["description"],
-                    weight=r["weight"],
-                    price=float(r["price"]),
-                    image_url=r.get("image_url") or None,
-                    stock=int(r.get("stock", 0)),
-                    is_bestseller=r.get("is_bestseller", "FALSE").lower() == "true",
-                    version=r.get("version", "0")
+                products[str(r[c["id"]])] = Product(
+                    cat=sys.intern(str(r[c["cat"]])),
+                    fa=sys.intern(str(r[c["fa"]])),
+                    it=sys.intern(str(r[c["it"]])),
+                    brand=r[c["brand"]],
+                    desc=r[c["description"]],
+                    weight=sys.intern(str(r[c["weight"]])),
+                    price=float(r[c["price"]]),
+                    image_url=str(col(r, "image_url") or "").strip() or None,
+                    stock=int(col(r, "stock", 0) or 0),
+                    is_bestseller=str(col(r, "is_bestseller", "FALSE")).lower() == "true",
+                    version=str(col(r, "version", "0"))
                 )
-            except (ValueError, KeyError) as e:
+            except (ValueError, TypeError) as e:
                 log.error(f"Invalid product data in row: {r}, error: {e}")
                 continue
         if not products:
@@ -262,7 +442,7 @@ async def load_products() -> Dict[str, Dict[str, Any]]:
 
 async def load_discounts():
     try:
-        records = await asyncio.to_thread(discounts_ws.get_all_records)
+        records = await run_sheets(discounts_ws.get_all_records)
         required_cols = ["code", "discount_percent", "valid_until", "is_active"]
         if records and not all(col in records[0] for col in required_cols):
             missing = [col for col in required_cols if col not in records[0]]
@@ -273,7 +453,8 @@ async def load_discounts():
             try:
                 discounts[r["code"]] = dict(
                     discount_percent=float(r["discount_percent"]),
-                    valid_until=r["valid_until"],
+                    # Parsed once per load; a malformed date skips the row here instead of failing checkout
+                    valid_until=dt.datetime.fromisoformat(str(r["valid_until"])).replace(tzinfo=dt.UTC),
                     is_active=r["is_active"].lower() == "true"
                 )
             except (ValueError, KeyError) as e:
@@ -284,29 +465,163 @@ async def load_discounts():
         log.error(f"Error loading discounts: {e}")
         return {}
 
-# Versioned cache for products
-async def get_products():
+# The code is checked in ask_notes and priced again in confirm_order moments later; a short-lived
+# copy saves the second sheet read. Checkouts that miss the cache together await the same load
+# (_discounts_load). Failed loads aren't cached.
+DISCOUNTS_TTL = 60
+_discounts_cache: Tuple[float, Dict[str, Dict[str, Any]]] = (0.0, {})
+_discounts_load: asyncio.Task | None = None
+
+async def get_discounts():
+    global _discounts_cache, _discounts_load
+    loaded_at, discounts = _discounts_cache
+    if time.monotonic() - loaded_at <= DISCOUNTS_TTL:
+        return discounts
+    if _discounts_load is None or _discounts_load.done():
+        _discounts_load = asyncio.create_task(load_discounts())
+    # Shielded: one waiter being cancelled must not cancel the load the others are waiting for
+    if discounts := await asyncio.shield(_discounts_load):
+        _discounts_cache = (time.monotonic(), discounts)
+    return discounts
+
+# Versioned cache for products: served from memory, refreshed by a background job
+# and snapshotted to disk so a cold start can skip the Sheets round-trip
+PRODUCTS_SNAPSHOT = os.getenv("PRODUCTS_SNAPSHOT", "/tmp/products.pkl")
+PRODUCTS_TTL = 600     # seconds before a full reload; also the snapshot max age
+PRODUCTS_CHECK = 60    # seconds between version checks of cell L1
+_products_lock = asyncio.Lock()
+
+def _set_products(products, version):
+    get_products._data = products
+    get_products._version = version
+    get_products._ts = time.monotonic() + PRODUCTS_TTL
+    index_products(products)
+
+def _load_snapshot():
     try:
-        cell = await asyncio.to_thread(products_ws.acell, "L1")
-        current_version = cell.value or "0"
-        if (not hasattr(get_products, "_data") or
-            not hasattr(get_products, "_version") or
-            get_products._version != current_version or
-            dt.datetime.utcnow() > getattr(get_products, "_ts", dt.datetime.min)):
-            get_products._data = await load_products()
-            get_products._version = current_version
-            get_products._ts = dt.datetime.utcnow() + dt.timedelta(seconds=60)
-            log.info(f"Loaded {len(get_products._data)} products from Google Sheets, version {current_version}")
-        return get_products._data
+        if time.time() - os.path.getmtime(PRODUCTS_SNAPSHOT) > PRODUCTS_TTL:
+            return None
+        with open(PRODUCTS_SNAPSHOT, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
     except Exception as e:
-        log.error(f"Error in get_products: {e}")
-        if ADMIN_ID and bot:
-            try:
-                await bot.send_message(ADMIN_ID, f"⚠️ خطا در بارگذاری محصولات: {e}")
-            except Exception as admin_e:
-                log.error(f"Failed to notify admin: {admin_e}")
+        log.error(f"Failed to read products snapshot: {e}")
+        return None
+
+def _save_snapshot(products, version):
+    try:
+        tmp = f"{PRODUCTS_SNAPSHOT}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump({"version": version, "data": products}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, PRODUCTS_SNAPSHOT)
+    except Exception as e:
+        log.error(f"Failed to write products snapshot: {e}")
+
+async def refresh_products(force=False):
+    try:
+        cell = await sheets_get("products", "L1", "FORMATTED_VALUE")
+        current_version = cell[0][0] if cell and cell[0] else "0"
+        if (force or
+            getattr(get_products, "_version", None) != current_version or
+            time.monotonic() > getattr(get_products, "_ts", 0)):
+            products = await load_products()
+            _set_products(products, current_version)
+            await asyncio.to_thread(_save_snapshot, products, current_version)
+            log.info(f"Loaded {len(products)} products from Google Sheets, version {current_version}")
+    except Exception as e:
+        log.error(f"Error in refresh_products: {e}")
+        notify_admin(f"⚠️ خطا در بارگذاری محصولات: {e}")
         raise
 
+async def refresh_products_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await refresh_products()
+    except (Exception, SystemExit) as e:
+        log.error(f"Background product refresh failed, serving cached data: {e}")
+
+async def get_products():
+    if hasattr(get_products, "_data"):
+        return get_products._data
+    async with _products_lock:
+        if not hasattr(get_products, "_data"):
+            snapshot = _load_snapshot()
+            if snapshot:
+                _set_products(snapshot["data"], snapshot["version"])
+                log.info(f"Loaded {len(snapshot['data'])} products from snapshot, version {snapshot['version']}")
+            else:
+                await refresh_products(force=True)
+    return get_products._data
+
+# Derived indexes, rebuilt together with the products cache
+SEARCH_KEYS: List[str] = []
+SEARCH_HAYSTACK: List[str] = []
+SEARCH_BLOB = ""
+SEARCH_STARTS: List[int] = [0]
+CATEGORIES: List[str] = []
+PRODUCTS_BY_CAT: Dict[str, List[Tuple[str, Product]]] = {}
+PRODUCT_CAP: Dict[str, str] = {}
+SEARCH_CAP: Dict[str, str] = {}
+SEARCH_KB: Dict[str, InlineKeyboardMarkup] = {}
+PRODUCT_KB: Dict[str, InlineKeyboardMarkup] = {}
+CAT_KB: Dict[str, InlineKeyboardMarkup] = {}
+MAIN_CAT_ROWS: List[Tuple[InlineKeyboardButton, ...]] = []
+MAIN_KB: InlineKeyboardMarkup = None
+BESTSELLER_KB: InlineKeyboardMarkup = None
+LOW_STOCK_PIDS: set = set()
+LINE_TMPL: Dict[str, str] = {}
+
+def substring_hits(q, limit):
+    # str.find over the joined haystack scans in C; bisect maps each hit back to its product
+    hits, pos = [], SEARCH_BLOB.find(q)
+    while pos != -1 and len(hits) < limit:
+        idx = bisect.bisect_right(SEARCH_STARTS, pos) - 1
+        hits.append(idx)
+        pos = SEARCH_BLOB.find(q, SEARCH_STARTS[idx + 1])
+    return hits
+
+def cart_line_tmpl(fa, weight) -> str:
+    # Name and weight are fixed per product; qty, price and subtotal are filled per render
+    label = html.escape(f"{fa} ({weight})").replace("{", "{{").replace("}", "}}")
+    return "▫️ {qty}× " + label + " — {price:.2f}€ = <b>{sub:.2f}€</b>"
+
+def index_products(products: Dict[str, Product]):
+    global SEARCH_KEYS, SEARCH_HAYSTACK, SEARCH_BLOB, SEARCH_STARTS, CATEGORIES, PRODUCTS_BY_CAT, PRODUCT_CAP, SEARCH_CAP, SEARCH_KB, PRODUCT_KB, CAT_KB, MAIN_CAT_ROWS, MAIN_KB, BESTSELLER_KB, LOW_STOCK_PIDS, LINE_TMPL
+    by_cat = {}
+    for pid, p in products.items():
+        by_cat.setdefault(p.cat, []).append((pid, p))
+    SEARCH_KEYS = list(products)
+    SEARCH_HAYSTACK = [f"{p.fa} {p.it}".lower() for p in products.values()]
+    # All haystacks in one string, with each entry's start offset (plus an end sentinel)
+    SEARCH_BLOB = "\n".join(SEARCH_HAYSTACK)
+    SEARCH_STARTS = [0]
+    for hay in SEARCH_HAYSTACK:
+        SEARCH_STARTS.append(SEARCH_STARTS[-1] + len(hay) + 1)
+    CATEGORIES = list(by_cat)
+    PRODUCTS_BY_CAT = by_cat
+    # Sheet text is escaped once here; stock changes between reloads, so it is appended when sent
+    esc = html.escape
+    # Captions end with the stock label; handlers only append the current stock number
+    PRODUCT_CAP = {pid: f"<b>{esc(p.fa)} / {esc(p.it)}</b>\n{esc(str(p.desc))}\n{p.price}€ / {esc(p.weight)}"
+                        "\n<tg-spoiler>موجودی / Stock:</tg-spoiler> "
+                   for pid, p in products.items()}
+    SEARCH_CAP = {pid: f"{esc(p.fa)} / {esc(p.it)}\n{esc(str(p.desc))}\n{p.price}€\nموجودی / Stock: "
+                  for pid, p in products.items()}
+    add_label = m("CART_ADDED").split("\n")[0]
+    SEARCH_KB = {pid: InlineKeyboardMarkup.from_button(InlineKeyboardButton(add_label, callback_data=f"add_{pid}"))
+                 for pid in products}
+    PRODUCT_KB = {pid: build_kb_product(pid, p) for pid, p in products.items()}
+    CAT_KB = {cat: build_kb_category(items) for cat, items in by_cat.items()}
+    MAIN_CAT_ROWS = [(InlineKeyboardButton(EMOJI.get(c, c), callback_data=f"cat_{c}"),) for c in CATEGORIES]
+    MAIN_KB = build_kb_main()
+    kb_main_for.cache_clear()
+    bestsellers = [(pid, p) for pid, p in products.items() if p.is_bestseller]
+    BESTSELLER_KB = build_kb_bestsellers(bestsellers) if bestsellers else None
+    LOW_STOCK_PIDS = {pid for pid, p in products.items() if p.stock <= LOW_STOCK_TH}
+    LINE_TMPL = {pid: cart_line_tmpl(p.fa, p.weight) for pid, p in products.items()}
+
+DESTINATIONS = {"order_perugia": "Perugia", "order_italy": "Italy"}
+
 EMOJI = {
     "rice": "🍚 برنج / Riso", "beans": "🥣 حبوبات / Legumi", "spice": "🌿 ادویه / Spezie",
     "nuts": "🥜 خشکبار / Frutta secca", "drink": "🧃 نوشیدنی / Bevande",
@@ -314,20 +629,55 @@ EMOJI = {
 }
 
 # ───────────── Helpers
-cart_total = lambda c: sum(i["qty"] * i["price"] for i in c)
-cart_count = lambda ctx: sum(i["qty"] for i in ctx.user_data.get("cart", []))
+@dataclass(slots=True)
+class CartItem:
+    id: str
+    fa: str
+    weight: str
+    price: float
+    qty: int
+
+# Answers of the order form; one slotted object per session instead of six user_data keys
+@dataclass(slots=True)
+class OrderForm:
+    name: str = ""
+    phone: str = ""
+    address: str = ""
+    postal: str = ""
+    discount_code: str = ""
+    notes: str = ""
+
+cart_total = lambda c: sum(i.qty * i.price for i in c.values())
+
+def as_cart(cart):
+    # Carts are keyed by product id; abandoned-cart sheet rows hold plain dicts (lists before that)
+    if isinstance(cart, list):
+        cart = {i["id"]: i for i in cart}
+    return {pid: i if isinstance(i, CartItem) else
+            CartItem(pid, i["fa"], str(i.get("weight", "")), i["price"], i["qty"])
+            for pid, i in cart.items()}
+
+def get_form(ctx) -> OrderForm:
+    if (form := ctx.user_data.get("form")) is None:
+        form = ctx.user_data["form"] = OrderForm()
+    return form
+
+def get_cart(ctx):
+    return ctx.user_data.setdefault("cart", {})
 
 async def safe_edit(q, *args, **kwargs):
     try:
         if q.message.text:
-            await q.edit_message_text(*args, **kwargs)
+            # Same text (e.g. back to the category already on screen): only swap the keyboard
+            text = args[0] if args else kwargs.get("text")
+            if text == q.message.text or (kwargs.get("parse_mode") == "HTML" and text == q.message.text_html):
+                await q.edit_message_reply_markup(reply_markup=kwargs.get("reply_markup"))
+            else:
+                await q.edit_message_text(*args, **kwargs)
         elif q.message.caption is not None or q.message.photo:
-            await q.edit_message_caption(caption=args[0], reply_markup=kwargs.get("reply_markup"))
+            await q.edit_message_caption(caption=args[0], reply_markup=kwargs.get("reply_markup"), parse_mode=kwargs.get("parse_mode"))
         else:
-            try:
-                await q.message.delete()
-            except Exception:
-                pass
+            run_background(delete_quietly(q.message))
             await q.message.chat.send_message(*args, **kwargs)
 
     except BadRequest as e:
@@ -335,106 +685,209 @@ async def safe_edit(q, *args, **kwargs):
         if "not modified" in err or "There is no text" in err:
             return                 # خطاهای بی‌اهمیت را نادیده بگیر
         log.error(f"Edit msg error: {err}")
-        try:
-            await q.message.delete()
-        except Exception:
-            pass
+        run_background(delete_quietly(q.message))
         await q.message.chat.send_message(*args, **kwargs)
     except NetworkError as e:
         log.error(f"Network error: {e}")
 
 
 
-async def alert_admin(pid, stock):
-    if stock <= LOW_STOCK_TH and ADMIN_ID:
+# Sheet timestamps have one-second resolution, so the formatted string is reused within a second
+_now_sec, _now_str = 0, ""
+
+def now_str() -> str:
+    global _now_sec, _now_str
+    sec = int(time.time())
+    if sec != _now_sec:
+        _now_sec, _now_str = sec, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(sec))
+    return _now_str
+
+# Customers often type numbers with Persian or Arabic-Indic digits; form answers are stored with 0-9
+LATIN_DIGITS = str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩", "0123456789" * 2)
+phone_re = re.compile(r"\+?[\d ()\-]{7,20}", re.ASCII)
+
+def ok_phone(p: str) -> bool:
+    return phone_re.fullmatch(p.strip()) is not None
+
+postal_re = re.compile(r"\d{5}", re.ASCII)
+
+def ok_postal(p: str) -> bool:
+    return postal_re.fullmatch(p) is not None
+
+# Addresses vary too much to pattern-check (named buildings, house numbers sent apart); only blank
+# answers are rejected
+def ok_addr(a: str) -> bool:
+    return bool(a.strip())
+
+# Strong references to fire-and-forget tasks so they are not garbage-collected mid-flight
+_background_tasks = set()
+
+def run_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def best_effort(coro, what):
+    try:
+        return await coro
+    except Exception as e:
+        log.error(f"{what} failed: {e}")
+
+# Admin alerts never hold up the user or the job that raised them: sent in the background, failures only logged
+def notify_admin(text):
+    if ADMIN_ID and bot:
+        run_background(best_effort(bot.send_message(ADMIN_ID, text), "Admin notification"))
+
+def user_handle(ctx, user) -> str:
+    # "@username" or "-", worked out once and kept in user_data for the rest of the session
+    if (handle := ctx.user_data.get("handle")) is None:
+        handle = ctx.user_data["handle"] = f"@{user.username}" if user.username else "-"
+    return handle
+
+async def answer_quietly(q, *args, **kwargs):
+    try:
+        await q.answer(*args, **kwargs)
+    except Exception as e:
+        log.error(f"Callback answer failed: {e}")
+
+# A message being replaced is deleted alongside sending its successor, not before it
+async def delete_quietly(message):
+    try:
+        await message.delete()
+    except Exception as e:
+        log.debug(f"Deleting message failed: {e}")
+
+# Telegram file_ids of product images, keyed by URL and kept in (persisted) bot_data;
+# resending a file_id skips Telegram's fetch of the external image
+async def send_product_photo(send, ctx, url, **kwargs):
+    ids = ctx.bot_data.setdefault("photo_ids", {})
+    if file_id := ids.get(url):
+        try:
+            return await send(photo=file_id, **kwargs)
+        except BadRequest as e:
+            log.error(f"Cached file_id for {url} rejected, re-sending URL: {e}")
+            ids.pop(url, None)
+    msg = await send(photo=url, **kwargs)
+    if msg.photo:
+        ids[url] = msg.photo[-1].file_id
+    return msg
+
+async def alert_admin(pid):
+    if pid in LOW_STOCK_PIDS and ADMIN_ID:
+        p = (await get_products())[pid]
+        name, stock = p.fa, p.stock
         for _ in range(3):
             try:
-                await bot.send_message(ADMIN_ID, f"⚠️ موجودی کم {stock}: {(await get_products())[pid]['fa']}")
-                log.info(f"Low stock alert sent for {(await get_products())[pid]['fa']}")
+                await bot.send_message(ADMIN_ID, f"⚠️ موجودی کم {stock}: {name}")
+                log.info(f"Low stock alert sent for {name}")
                 break
             except Exception as e:
                 log.error(f"Alert fail attempt: {e}")
                 await asyncio.sleep(1)
 
 # ───────────── Keyboards
+# Markups are immutable once built, so the static parts are shared across users and callbacks
+BTN_SEARCH_ROW = (InlineKeyboardButton(m("BTN_SEARCH"), callback_data="search"),
+                  InlineKeyboardButton("🔥 پرفروش‌ها / Più venduti", callback_data="bestsellers"))
+BTN_CART = InlineKeyboardButton(m("BTN_CART"), callback_data="cart")
+BTN_SUPPORT_ROW = (InlineKeyboardButton("📞 پشتیبانی / Supporto", callback_data="support"),)
+CART_TAIL_ROWS = (
+    (InlineKeyboardButton(m("BTN_ORDER_PERUGIA"), callback_data="order_perugia"),
+     InlineKeyboardButton(m("BTN_ORDER_ITALY"), callback_data="order_italy")),
+    (InlineKeyboardButton(m("BTN_CONTINUE"), callback_data="checkout"),
+     InlineKeyboardButton(m("BTN_BACK"), callback_data="back")),
+)
+REMOVE_KB = ReplyKeyboardRemove()
+SUPPORT_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📷 ارسال تصویر / Invia immagine", callback_data="upload_photo")],
+    [InlineKeyboardButton(m("BTN_BACK"), callback_data="back")]
+])
+
+def build_kb_main(cart_btn=BTN_CART):
+    rows = MAIN_CAT_ROWS + [BTN_SEARCH_ROW, (cart_btn,), BTN_SUPPORT_ROW]
+    return InlineKeyboardMarkup(rows)
+
+# Main menus with a cart summary repeat across users (same item count and total); dropped on reindex.
+# Keyed by the numbers, so a hit skips formatting the button label too
+@functools.lru_cache(maxsize=256)
+def kb_main_for(count, total):
+    label = f"{m('BTN_CART')} ({count} آیتم - {total:.2f}€)"
+    return build_kb_main(InlineKeyboardButton(label, callback_data="cart"))
+
 async def kb_main(ctx):
     try:
-        cats = {p["cat"] for p in (await get_products()).values()}
-        rows = [[InlineKeyboardButton(EMOJI.get(c, c), callback_data=f"cat_{c}")] for c in cats]
-        cart = ctx.user_data.get("cart", [])
-        cart_summary = f"{m('BTN_CART')} ({cart_count(ctx)} آیتم - {cart_total(cart):.2f}€)" if cart else m("BTN_CART")
-        rows.append([
-            InlineKeyboardButton(m("BTN_SEARCH"), callback_data="search"),
-            InlineKeyboardButton("🔥 پرفروش‌ها / Più venduti", callback_data="bestsellers")
-        ])
-        rows.append([
-            InlineKeyboardButton(cart_summary, callback_data="cart")
-        ])
-        rows.append([
-            InlineKeyboardButton("📞 پشتیبانی / Supporto", callback_data="support")
-        ])
-        return InlineKeyboardMarkup(rows)
+        await get_products()
+        cart = get_cart(ctx)
+        if not cart:
+            return MAIN_KB
+        return kb_main_for(sum(i.qty for i in cart.values()), round(cart_total(cart), 2))
     except Exception as e:
         log.error(f"Error in kb_main: {e}")
         raise
 
-async def kb_category(cat, ctx):
+def build_kb_category(items):
+    rows = [[InlineKeyboardButton(f"{p.fa} / {p.it}", callback_data=f"show_{pid}")]
+            for pid, p in items]
+    rows.append([
+        InlineKeyboardButton(m("BTN_SEARCH"), callback_data="search"),
+        InlineKeyboardButton(m("BTN_BACK"), callback_data="back")
+    ])
+    return InlineKeyboardMarkup(rows)
+
+EMPTY_CAT_KB = build_kb_category([])
+
+def build_kb_bestsellers(items):
+    rows = [[InlineKeyboardButton(f"{p.fa} / {p.it}", callback_data=f"show_{pid}")] for pid, p in items]
+    rows.append([InlineKeyboardButton(m("BTN_BACK"), callback_data="back")])
+    return InlineKeyboardMarkup(rows)
+
+def build_kb_product(pid, p):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(m("CART_ADDED").split("\n")[0], callback_data=f"add_{pid}")],
+        [InlineKeyboardButton(m("BTN_BACK"), callback_data=f"cat_{p.cat}")]
+    ])
+
+async def kb_category(cat):
     try:
-        rows = [[InlineKeyboardButton(f"{p['fa']} / {p['it']}", callback_data=f"show_{pid}")]
-                for pid, p in (await get_products()).items() if p["cat"] == cat]
-        rows.append([
-            InlineKeyboardButton(m("BTN_SEARCH"), callback_data="search"),
-            InlineKeyboardButton(m("BTN_BACK"), callback_data="back")
-        ])
-        return InlineKeyboardMarkup(rows)
+        await get_products()
+        return CAT_KB.get(cat) or EMPTY_CAT_KB
     except Exception as e:
         log.error(f"Error in kb_category: {e}")
         raise
 
 def kb_product(pid):
     try:
-        p = get_products._data[pid] if hasattr(get_products, "_data") else (asyncio.run(get_products()))[pid]
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton(m("CART_ADDED").split("\n")[0], callback_data=f"add_{pid}")],
-            [InlineKeyboardButton(m("BTN_BACK"), callback_data=f"back_cat_{p['cat']}")]
-        ])
+        return PRODUCT_KB[pid]
     except Exception as e:
         log.error(f"Error in kb_product: {e}")
         raise
 
+@functools.lru_cache(maxsize=1024)
+def cart_buttons(pid):
+    return (InlineKeyboardButton("➕", callback_data=f"inc_{pid}"),
+            InlineKeyboardButton("➖", callback_data=f"dec_{pid}"),
+            InlineKeyboardButton("❌", callback_data=f"del_{pid}"))
+
+# Keyed by the cart's (pid, qty, name) lines: pressing ➕ then ➖ (or re-opening the cart) reuses the markup
+@functools.lru_cache(maxsize=1024)
+def kb_cart_for(lines):
+    rows = []
+    for pid, qty, name in lines:
+        inc, dec, rm = cart_buttons(pid)
+        rows.append((inc, InlineKeyboardButton(f"{qty}× {name}", callback_data="ignore"), dec, rm))
+    rows.extend(CART_TAIL_ROWS)
+    return InlineKeyboardMarkup(rows)
+
 def kb_cart(cart):
     try:
-        rows = []
-        for it in cart:
-            pid = it["id"]
-            rows.append([
-                InlineKeyboardButton("➕", callback_data=f"inc_{pid}"),
-                InlineKeyboardButton(f"{it['qty']}× {it['fa']}", callback_data="ignore"),
-                InlineKeyboardButton("➖", callback_data=f"dec_{pid}"),
-                InlineKeyboardButton("❌", callback_data=f"del_{pid}")
-            ])
-        rows.append([
-            InlineKeyboardButton(m("BTN_ORDER_PERUGIA"), callback_data="order_perugia"),
-            InlineKeyboardButton(m("BTN_ORDER_ITALY"), callback_data="order_italy")
-        ])
-        rows.append([
-            InlineKeyboardButton(m("BTN_CONTINUE"), callback_data="checkout"),
-            InlineKeyboardButton(m("BTN_BACK"), callback_data="back")
-        ])
-        return InlineKeyboardMarkup(rows)
+        return kb_cart_for(tuple((pid, it.qty, it.fa) for pid, it in cart.items()))
     except Exception as e:
         log.error(f"Error in kb_cart: {e}")
         raise
 
 def kb_support():
-    try:
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("📷 ارسال تصویر / Invia immagine", callback_data="upload_photo")],
-            [InlineKeyboardButton(m("BTN_BACK"), callback_data="back")]
-        ])
-    except Exception as e:
-        log.error(f"Error in kb_support: {e}")
-        raise
+    return SUPPORT_KB
 
 # ───────────── Cart operations
 async def add_cart(ctx, pid, qty=1, update=None):
@@ -443,26 +896,19 @@ async def add_cart(ctx, pid, qty=1, update=None):
         if pid not in prods:
             return False, m("STOCK_EMPTY")
         p = prods[pid]
-        stock = p["stock"]
-        cart = ctx.user_data.setdefault("cart", [])
-        cur = next((i for i in cart if i["id"] == pid), None)
-        cur_qty = cur["qty"] if cur else 0
+        stock = p.stock
+        cart = get_cart(ctx)
+        cur = cart.get(pid)
+        cur_qty = cur.qty if cur else 0
         if stock < cur_qty + qty:
             return False, m("STOCK_EMPTY")
         if cur:
-            cur["qty"] += qty
+            cur.qty += qty
         else:
-            cart.append(dict(id=pid, fa=p["fa"], price=p["price"], weight=p["weight"], qty=qty))
-        await alert_admin(pid, stock)
-        try:
-            await asyncio.to_thread(
-                abandoned_cart_ws.append_row,
-                [dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                 ctx.user_data.get("user_id", update.effective_user.id if update else 0),
-                 json.dumps(cart)]
-            )
-        except Exception as e:
-            log.error(f"Error saving abandoned cart: {e}")
+            cart[pid] = CartItem(pid, p.fa, p.weight, p.price, qty)
+        if pid in LOW_STOCK_PIDS:
+            run_background(alert_admin(pid))
+        snapshot_cart(ctx.user_data.get("user_id", update.effective_user.id if update else 0), cart)
         return True, m("CART_ADDED")
     except Exception as e:
         log.error(f"Error in add_cart: {e}")
@@ -472,14 +918,15 @@ def fmt_cart(cart):
     try:
         if not cart:
             return m("CART_EMPTY")
-        lines = ["🛍 **سبد خرید / Carrello:**", ""]
+        lines = ["🛍 <b>سبد خرید / Carrello:</b>", ""]
         tot = 0
-        for it in cart:
-            sub = it["qty"] * it["price"]
+        for pid, it in cart.items():
+            sub = it.qty * it.price
             tot += sub
-            lines.append(f"▫️ {it['qty']}× {it['fa']} — {sub:.2f}€")
+            tmpl = LINE_TMPL.get(pid) or cart_line_tmpl(it.fa, it.weight)
+            lines.append(tmpl.format(qty=it.qty, price=it.price, sub=sub))
         lines.append("")
-        lines.append(f"💶 **جمع / Totale:** {tot:.2f}€")
+        lines.append(f"💶 <b>جمع / Totale:</b> {tot:.2f}€")
         return "\n".join(lines)
     except Exception as e:
         log.error(f"Error in fmt_cart: {e}")
@@ -488,41 +935,181 @@ def fmt_cart(cart):
 # ───────────── Stock update
 async def update_stock(cart):
     try:
-        records = await asyncio.to_thread(products_ws.get_all_records)
-        for it in cart:
-            pid = it["id"]
-            qty = it["qty"]
-            for idx, row in enumerate(records, start=2):
-                if row["id"] == pid:
-                    new = int(row["stock"]) - qty
+        rows = await sheets_get("products", PRODUCT_RANGE)
+        id_col, stock_col = PRODUCT_COLS["id"], PRODUCT_COLS["stock"]
+        stock_letter = gspread.utils.rowcol_to_a1(1, stock_col + 1)[:-1]
+        # Every new stock value is checked before anything is written, so an order
+        # never leaves the sheet half-decremented
+        updates = {}
+        for pid, it in cart.items():
+            for idx, row in enumerate(rows, start=2):
+                if row and str(row[id_col]) == pid:
+                    new = int(row[stock_col] if len(row) > stock_col and row[stock_col] != "" else 0) - it.qty
                     if new < 0:
                         log.error(f"Cannot update stock for {pid}: negative stock")
                         return False
-                    await asyncio.to_thread(products_ws.update_cell, idx, 10, new)
-                    (await get_products())[pid]["stock"] = new
-                    log.info(f"Updated stock for {pid}: {new}")
+                    updates[pid] = (f"{stock_letter}{idx}", new)
+        if updates:
+            await sheets_update("products", dict(updates.values()))
+        products = await get_products()
+        for pid, (_, new) in updates.items():
+            products[pid].stock = new
+            if new <= LOW_STOCK_TH:
+                LOW_STOCK_PIDS.add(pid)
+            else:
+                LOW_STOCK_PIDS.discard(pid)
+            log.info(f"Updated stock for {pid}: {new}")
         return True
-    except gspread.exceptions.APIError as e:
+    except httpx.HTTPStatusError as e:
         log.error(f"Google Sheets API error during stock update: {e}")
-        if ADMIN_ID and bot:
-            await bot.send_message(ADMIN_ID, f"⚠️ خطا در به‌روزرسانی موجودی: {e}")
+        notify_admin(f"⚠️ خطا در به‌روزرسانی موجودی: {e}")
         return False
     except Exception as e:
         log.error(f"Stock update error: {e}")
         return False
 
+# ───────────── Order writer
+# Confirmed orders go to a local SQLite outbox first (one record = all sheet rows of one order),
+# so an order survives a crash or a Sheets outage; flush_orders copies them to the sheet in batches.
+# That only holds across redeploys when ORDERS_DB is on a mounted disk
+ORDERS_DB = os.getenv("ORDERS_DB", "/tmp/pending_orders.db")
+ORDERS_FLUSH = 3
+ORDERS_BATCH = 50
+if on_ephemeral_disk(ORDERS_DB):
+    log.warning(f"ORDERS_DB {ORDERS_DB} is on an ephemeral disk: orders still waiting for Google Sheets "
+                f"are lost on redeploy; point ORDERS_DB at a persistent disk")
+orders_db = sqlite3.connect(ORDERS_DB, isolation_level=None, check_same_thread=False)
+orders_db.execute("PRAGMA journal_mode=WAL")
+orders_db.execute("PRAGMA synchronous=NORMAL")
+orders_db.execute("CREATE TABLE IF NOT EXISTS pending_orders (id INTEGER PRIMARY KEY, rows BLOB NOT NULL)")
+# Commits can wait on fsync, so the outbox is used from its own thread; one thread, one connection
+OUTBOX_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+_pending_count = orders_db.execute("SELECT COUNT(*) FROM pending_orders").fetchone()[0]
+_flush_lock = asyncio.Lock()
+
+def run_outbox(sql, *params):
+    return asyncio.get_running_loop().run_in_executor(
+        OUTBOX_POOL, lambda: orders_db.execute(sql, params).fetchall())
+
+async def queue_order(rows):
+    global _pending_count
+    await run_outbox("INSERT INTO pending_orders (rows) VALUES (?)", orjson.dumps(rows))
+    _pending_count += 1
+
+def pending_orders() -> int:
+    return _pending_count
+
+async def flush_orders():
+    global _pending_count
+    # One flush at a time: a concurrent one would read, and append, the same outbox records
+    if _flush_lock.locked():
+        return
+    async with _flush_lock:
+        batch = await run_outbox("SELECT id, rows FROM pending_orders ORDER BY id LIMIT ?", ORDERS_BATCH)
+        if not batch:
+            return
+        rows = [row for _, order in batch for row in orjson.loads(order)]
+        try:
+            await sheets_append("orders", rows)
+        except Exception as e:
+            log.error(f"Error writing {len(batch)} orders to Google Sheets: {e}")
+            notify_admin(f"⚠️ خطا در ثبت {len(batch)} سفارش در Google Sheets (تلاش مجدد): {e}")
+            return
+        await run_outbox("DELETE FROM pending_orders WHERE id <= ?", batch[-1][0])
+        _pending_count -= len(batch)
+        log.info(f"Wrote {len(batch)} orders ({len(rows)} rows) to Google Sheets")
+
+# Orders still in an outbox on an ephemeral disk at shutdown would vanish with the deploy; they are
+# sent to the admin chat as a file instead, so an order the customer was told is confirmed isn't lost
+async def export_pending_orders():
+    try:
+        batch = await run_outbox("SELECT rows FROM pending_orders ORDER BY id")
+        doc = io.BytesIO(orjson.dumps([orjson.loads(order) for (order,) in batch], option=orjson.OPT_INDENT_2))
+        doc.name = f"pending_orders_{dt.datetime.now(dt.UTC):%Y%m%d_%H%M%S}.json"
+        await bot.send_document(ADMIN_ID, document=doc, caption=(
+            f"⚠️ {len(batch)} سفارش در Google Sheets ثبت نشد و فایل {ORDERS_DB} با این استقرار پاک می‌شود؛ "
+            f"لطفاً دستی ثبت کنید."))
+        log.info(f"Sent {len(batch)} pending orders to the admin chat")
+    except Exception as e:
+        log.error(f"Failed to export {pending_orders()} pending orders, they are lost with {ORDERS_DB}: {e}")
+
+# Abandoned-cart rows are coalesced per user: only the latest cart of each user is written per flush
+CART_SNAPSHOTS: Dict[Any, list] = {}
+
+# Each confirmed order resets the sheet; orders between two flushes share one clear
+_carts_clear_pending = False
+
+def snapshot_cart(user_id, cart):
+    CART_SNAPSHOTS[user_id] = [now_str(), user_id, orjson.dumps(cart).decode()]
+
+def clear_cart_snapshots(ordered_by):
+    global _carts_clear_pending
+    _carts_clear_pending = True
+    CART_SNAPSHOTS.pop(ordered_by, None)    # a cart that was just ordered isn't abandoned
+
+# The periodic job and the shutdown flush can overlap; the later one waits instead of interleaving
+_carts_flush_lock = asyncio.Lock()
+
+async def flush_cart_snapshots():
+    global _carts_clear_pending
+    async with _carts_flush_lock:
+        if _carts_clear_pending:
+            try:
+                await sheets_clear("abandoned_carts")
+            except Exception as e:
+                # Appending now would put rows in the sheet that the next successful clear wipes
+                log.error(f"Error clearing abandoned carts, keeping {len(CART_SNAPSHOTS)} snapshots: {e}")
+                return
+            _carts_clear_pending = False
+        if not CART_SNAPSHOTS:
+            return
+        batch = dict(CART_SNAPSHOTS)
+        CART_SNAPSHOTS.clear()
+        try:
+            await sheets_append("abandoned_carts", list(batch.values()))
+        except Exception as e:
+            for user_id, row in batch.items():
+                CART_SNAPSHOTS.setdefault(user_id, row)
+            log.error(f"Error saving {len(batch)} abandoned carts: {e}")
+
+async def flush_orders_job(context: ContextTypes.DEFAULT_TYPE):
+    await flush_orders()
+    await flush_cart_snapshots()
+
 # ───────────── Order States
+# Filled with str.format_map over the per-order summary built in confirm_order
+ORDER_CAPTION_TMPL = (m("ORDER_CONFIRMED").replace("{", "{{").replace("}", "}}") +
+                      "\n\n📍 مقصد / Destinazione: {dest}\n💶 مجموع / Totale: {total:.2f}€"
+                      "\n🎁 تخفیف / Sconto: {discount:.2f}€\n📝 یادداشت / Nota: {notes}")
+ADMIN_ORDER_TMPL = ("🆕 سفارش / Ordine {order_id}\n{name} — {total:.2f}€"
+                    "\n🎁 تخفیف / Sconto: {discount:.2f}€ ({code})\n📝 یادداشت / Nota: {notes}\n")
 ASK_NAME, ASK_PHONE, ASK_ADDRESS, ASK_POSTAL, ASK_DISCOUNT, ASK_NOTES = range(6)
+CHECKOUT_DEBOUNCE = 2    # seconds
+ORDER_TIMEOUT = 15 * 60  # seconds of silence before an unfinished order form is dropped
+MAX_FIELD_LEN = 256      # free-text answers are cut to this before they reach the sheet
+# Shared filter instances for the order steps; /skip is the only command the optional steps
+# accept, others (e.g. /cancel) reach the fallbacks
+TEXT_INPUT = filters.TEXT & ~filters.COMMAND
+SKIP_INPUT = filters.Text(["/skip"]) | TEXT_INPUT
 
 # ───────────── Order Process
 async def start_order(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try:
         q = update.callback_query
         if not ctx.user_data.get("dest"):
-            await safe_edit(q, f"{m('CART_GUIDE')}\n\n{fmt_cart(ctx.user_data.get('cart', []))}", reply_markup=kb_cart(ctx.user_data.get("cart", [])), parse_mode="HTML")
+            cart = get_cart(ctx)
+            await safe_edit(q, CART_GUIDE_HTML + fmt_cart(cart), reply_markup=kb_cart(cart), parse_mode="HTML")
             return
-        ctx.user_data["name"] = f"{q.from_user.first_name} {(q.from_user.last_name or '')}".strip()
-        ctx.user_data["handle"] = f"@{q.from_user.username}" if q.from_user.username else "-"
+        if q.from_user.is_bot:
+            return ConversationHandler.END
+        # A double tap on checkout would restart the form and repeat the first prompt
+        now = time.time()
+        if now - ctx.user_data.get("checkout_at", 0) < CHECKOUT_DEBOUNCE:
+            return
+        ctx.user_data["checkout_at"] = now
+        ctx.user_data["form"] = OrderForm(name=f"{q.from_user.first_name} {(q.from_user.last_name or '')}".strip())
+        ctx.user_data.pop("handle", None)
+        user_handle(ctx, q.from_user)
         ctx.user_data["user_id"] = update.effective_user.id
         await q.message.reply_text(m("INPUT_NAME"))
         return ASK_NAME
@@ -531,55 +1118,41 @@ async def start_order(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await q.message.reply_text("❗️ خطا در شروع سفارش. لطفاً دوباره امتحان کنید.")
         return ConversationHandler.END
 
-async def ask_phone(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    try:
-        ctx.user_data["name"] = update.message.text.strip()
-        await update.message.reply_text(m("INPUT_PHONE"))
-        return ASK_PHONE
-    except Exception as e:
-        log.error(f"Error in ask_phone: {e}")
-        await update.message.reply_text("❗️ خطا در ثبت نام. لطفاً دوباره امتحان کنید.")
-        return ConversationHandler.END
-
-async def ask_address(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    try:
-        ctx.user_data["phone"] = update.message.text.strip()
-        await update.message.reply_text(m("INPUT_ADDRESS"))
-        return ASK_ADDRESS
-    except Exception as e:
-        log.error(f"Error in ask_address: {e}")
-        await update.message.reply_text("❗️ خطا در ثبت شماره تلفن. لطفاً دوباره امتحان کنید.")
-        return ConversationHandler.END
-
-async def ask_postal(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    try:
-        ctx.user_data["address"] = update.message.text.strip()
-        await update.message.reply_text(m("INPUT_POSTAL"))
-        return ASK_POSTAL
-    except Exception as e:
-        log.error(f"Error in ask_postal: {e}")
-        await update.message.reply_text("❗️ خطا در ثبت آدرس. لطفاً دوباره امتحان کنید.")
-        return ConversationHandler.END
+# Plain text steps of the order form: state -> (user_data key, validator, invalid message,
+# label for errors, next prompt, next state). One form_step serves all of them.
+FORM_STEPS = {
+    ASK_NAME: ("name", None, None, "نام", m("INPUT_PHONE"), ASK_PHONE),
+    ASK_PHONE: ("phone", ok_phone, m("PHONE_INVALID"), "شماره تلفن", m("INPUT_ADDRESS"), ASK_ADDRESS),
+    ASK_ADDRESS: ("address", ok_addr, m("ADDRESS_INVALID"), "آدرس", m("INPUT_POSTAL"), ASK_POSTAL),
+    ASK_POSTAL: ("postal", ok_postal, m("POSTAL_INVALID"), "کد پستی",
+                 "🎁 کد تخفیف دارید؟ وارد کنید یا /skip را بزنید.\nHai un codice sconto? Inseriscilo o premi /skip.",
+                 ASK_DISCOUNT),
+}
 
-async def ask_discount(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+async def form_step(state, update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    key, valid, invalid_msg, label, prompt, next_state = FORM_STEPS[state]
     try:
-        ctx.user_data["postal"] = update.message.text.strip()
-        await update.message.reply_text("🎁 کد تخفیف دارید؟ وارد کنید یا /skip را بزنید.\nHai un codice sconto? Inseriscilo o premi /skip.")
-        return ASK_DISCOUNT
+        value = update.message.text.strip()[:MAX_FIELD_LEN].translate(LATIN_DIGITS)
+        if valid and not valid(value):
+            await update.message.reply_text(invalid_msg)
+            return state
+        setattr(get_form(ctx), key, value)
+        await update.message.reply_text(prompt)
+        return next_state
     except Exception as e:
-        log.error(f"Error in ask_discount: {e}")
-        await update.message.reply_text("❗️ خطا در ثبت کد پستی. لطفاً دوباره امتحان کنید.")
+        log.error(f"Error in order step {key}: {e}")
+        await update.message.reply_text(f"❗️ خطا در ثبت {label}. لطفاً دوباره امتحان کنید.")
         return ConversationHandler.END
 
 async def ask_notes(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try:
         if update.message.text == "/skip":
-            ctx.user_data["discount_code"] = None
+            get_form(ctx).discount_code = ""
         else:
             code = update.message.text.strip()
-            discounts = await load_discounts()
-            if code in discounts and discounts[code]["is_active"] and dt.datetime.strptime(discounts[code]["valid_until"], "%Y-%m-%d") >= dt.datetime.utcnow():
-                ctx.user_data["discount_code"] = code
+            discounts = await get_discounts()
+            if code in discounts and discounts[code]["is_active"] and discounts[code]["valid_until"] >= dt.datetime.now(dt.UTC):
+                get_form(ctx).discount_code = code
             else:
                 await update.message.reply_text("❌ کد تخفیف نامعتبر است. لطفاً دوباره وارد کنید یا /skip کنید.\nCodice sconto non valido.")
                 return ASK_DISCOUNT
@@ -592,70 +1165,74 @@ async def ask_notes(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def confirm_order(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try:
-        if update.message.text == "/skip":
-            ctx.user_data["notes"] = ""
-        else:
-            ctx.user_data["notes"] = update.message.text.strip()
-        cart = ctx.user_data.get("cart", [])
+        form = get_form(ctx)
+        form.notes = "" if update.message.text == "/skip" else update.message.text.strip()[:MAX_FIELD_LEN]
+        cart = get_cart(ctx)
         if not cart:
-            await update.message.reply_text(m("CART_EMPTY"), reply_markup=ReplyKeyboardRemove())
+            await update.message.reply_text(m("CART_EMPTY"), reply_markup=REMOVE_KB)
             ctx.user_data.clear()
             return ConversationHandler.END
 
         if not await update_stock(cart):
-            await update.message.reply_text(m("STOCK_EMPTY"), reply_markup=ReplyKeyboardRemove())
+            await update.message.reply_text(m("STOCK_EMPTY"), reply_markup=REMOVE_KB)
             ctx.user_data.clear()
             return ConversationHandler.END
 
         order_id = str(uuid.uuid4())[:8]
-        ts = dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        ts = now_str()
         total = cart_total(cart)
         discount = 0
-        if ctx.user_data.get("discount_code"):
-            discounts = await load_discounts()
-            discount = total * (discounts[ctx.user_data["discount_code"]]["discount_percent"] / 100)
+        if form.discount_code:
+            discounts = await get_discounts()
+            discount = total * (discounts[form.discount_code]["discount_percent"] / 100)
             total -= discount
-        address_full = f"{ctx.user_data['address']} | {ctx.user_data['postal']}"
+        dest = ctx.user_data["dest"]
+        address_full = f"{form.address} | {form.postal}"
+        rows = [
+            [ts, order_id, ctx.user_data["user_id"], ctx.user_data["handle"],
+             form.name, form.phone, address_full,
+             dest, pid, it.fa, it.qty, it.price,
+             it.qty * it.price, form.notes,
+             form.discount_code, discount, "preparing", "FALSE"]
+            for pid, it in cart.items()
+        ]
         try:
-            for it in cart:
-                await asyncio.to_thread(
-                    orders_ws.append_row,
-                    [ts, order_id, ctx.user_data["user_id"], ctx.user_data["handle"],
-                     ctx.user_data["name"], ctx.user_data["phone"], address_full,
-                     ctx.user_data["dest"], it["id"], it["fa"], it["qty"], it["price"],
-                     it["qty"] * it["price"], ctx.user_data["notes"],
-                     ctx.user_data.get("discount_code", ""), discount, "preparing", "FALSE"]
-                )
-            log.info(f"Order {order_id} saved to Google Sheets for user {ctx.user_data['handle']}")
-            invoice_buffer = await generate_invoice(order_id, ctx.user_data, cart, total, discount)
-            await update.message.reply_photo(
-                photo=invoice_buffer,
-                caption=f"{m('ORDER_CONFIRMED')}\n\n📍 مقصد / Destinazione: {ctx.user_data['dest']}\n💶 مجموع / Totale: {total:.2f}€\n🎁 تخفیف / Sconto: {discount:.2f}€\n📝 یادداشت / Nota: {ctx.user_data['notes'] or 'بدون یادداشت'}",
-                reply_markup=ReplyKeyboardRemove()
-            )
+            await queue_order(rows)
+            log.info(f"Order {order_id} queued for Google Sheets for user {ctx.user_data['handle']}")
+            if pending_orders() >= ORDERS_BATCH:
+                # A full batch is written right away instead of waiting for the next flush tick
+                run_background(flush_orders())
+            invoice = (await asyncio.to_thread(
+                generate_invoice, order_id, form, dest, cart, total, discount)).getvalue()
         except Exception as e:
             log.error(f"Error saving order {order_id}: {e}")
-            await update.message.reply_text(m("ERROR_SHEET"), reply_markup=ReplyKeyboardRemove())
+            await update.message.reply_text(m("ERROR_SHEET"), reply_markup=REMOVE_KB)
             ctx.user_data.clear()
             return ConversationHandler.END
 
-        if promo := MSG.get("PROMO_AFTER_ORDER"):
-            await update.message.reply_text(promo, disable_web_page_preview=True)
+        summary = {"order_id": order_id, "total": total, "discount": discount, "name": form.name,
+                   "dest": dest, "notes": form.notes or "بدون یادداشت", "code": form.discount_code or "بدون کد"}
+        caption = ORDER_CAPTION_TMPL.format_map(summary)
+
+        async def notify_customer():
+            await update.message.reply_photo(photo=invoice, caption=caption, reply_markup=REMOVE_KB)
+            if promo := MSG.get("PROMO_AFTER_ORDER"):
+                await update.message.reply_text(promo, disable_web_page_preview=True)
+
+        # Only the customer's confirmation is awaited; the admin copy runs in the background and the
+        # abandoned-cart cleanup is left to the next flush
         if ADMIN_ID:
-            msg = [f"🆕 سفارش / Ordine {order_id}", f"{ctx.user_data['name']} — {total:.2f}€",
-                   f"🎁 تخفیف / Sconto: {discount:.2f}€ ({ctx.user_data.get('discount_code', 'بدون کد')})",
-                   f"📝 یادداشت / Nota: {ctx.user_data['notes'] or 'بدون یادداشت'}"] + \
-                  [f"▫️ {i['qty']}× {i['fa']}" for i in cart]
-            try:
-                invoice_buffer.seek(0)
-                await bot.send_photo(ADMIN_ID, photo=invoice_buffer, caption="\n".join(msg))
-                log.info(f"Admin notified for order {order_id}")
-            except Exception as e:
-                log.error(f"Failed to notify admin for order {order_id}: {e}")
+            items = "\n".join(f"▫️ {i.qty}× {i.fa}" for i in cart.values())
+            run_background(best_effort(
+                bot.send_photo(ADMIN_ID, photo=invoice, caption=ADMIN_ORDER_TMPL.format_map(summary) + items),
+                f"Order {order_id}: admin notification"))
+        clear_cart_snapshots(ctx.user_data["user_id"])
         try:
-            await asyncio.to_thread(abandoned_cart_ws.clear)
+            await notify_customer()
         except Exception as e:
-            log.error(f"Error clearing abandoned carts: {e}")
+            log.error(f"Order {order_id}: confirmation failed: {e}")
+            # The order is already queued; fall back to a plain-text confirmation
+            await update.message.reply_text(caption, reply_markup=REMOVE_KB)
         ctx.user_data.clear()
         return ConversationHandler.END
     except Exception as e:
@@ -667,17 +1244,22 @@ async def confirm_order(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cancel_order(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try:
         ctx.user_data.clear()
-        await update.message.reply_text(m("ORDER_CANCELLED"), reply_markup=ReplyKeyboardRemove())
+        await update.message.reply_text(m("ORDER_CANCELLED"), reply_markup=REMOVE_KB)
         return ConversationHandler.END
     except Exception as e:
         log.error(f"Error in cancel_order: {e}")
         await update.message.reply_text("❗️ خطا در لغو سفارش. لطفاً دوباره امتحان کنید.")
         return ConversationHandler.END
 
+async def order_timeout(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # An order form left idle for ORDER_TIMEOUT ends silently; only its answers go, the cart stays
+    ctx.user_data.pop("form", None)
+    ctx.user_data.pop("checkout_at", None)
+
 # ───────────── Photo Upload
 async def handle_photo(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try:
-        if not ctx.user_data.get("awaiting_photo"):
+        if not ctx.user_data.get("awaiting_photo") or update.effective_user.is_bot:
             return
         photo = update.message.photo[-1]
         if photo.file_size > 2 * 1024 * 1024:  # حداکثر 2 مگابایت
@@ -685,18 +1267,19 @@ async def handle_photo(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             ctx.user_data["awaiting_photo"] = False
             return
         file = await photo.get_file()
+        handle = user_handle(ctx, update.effective_user)
         try:
-            await asyncio.to_thread(
-                uploads_ws.append_row,
-                [dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                 update.effective_user.id,
-                 f"@{update.effective_user.username or '-'}",
-                 file.file_id]
+            await sheets_append(
+                "uploads",
+                [[now_str(),
+                  update.effective_user.id,
+                  handle,
+                  file.file_id]]
             )
             await bot.send_photo(
                 ADMIN_ID,
                 file.file_id,
-                caption=f"تصویر از کاربر @{update.effective_user.username or update.effective_user.id}\n📝 توضیح: {ctx.user_data.get('photo_note', 'بدون توضیح')}"
+                caption=f"تصویر از کاربر {handle if handle != '-' else update.effective_user.id}\n📝 توضیح: {ctx.user_data.get('photo_note', 'بدون توضیح')}"
             )
             await update.message.reply_text(m("PHOTO_UPLOADED"))
             ctx.user_data["awaiting_photo"] = False
@@ -714,12 +1297,12 @@ async def handle_photo(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def check_order_status(context: ContextTypes.DEFAULT_TYPE):
     try:
         last_checked_row = getattr(check_order_status, "_last_checked_row", 1)
-        shipped_cells = await asyncio.to_thread(orders_ws.findall, "shipped")
-        preparing_cells = await asyncio.to_thread(orders_ws.findall, "preparing")
+        shipped_cells = await run_sheets(orders_ws.findall, "shipped")
+        preparing_cells = await run_sheets(orders_ws.findall, "preparing")
         for cell in shipped_cells + preparing_cells:
             if cell.row <= last_checked_row:
                 continue
-            row_data = await asyncio.to_thread(orders_ws.row_values, cell.row)
+            row_data = await run_sheets(orders_ws.row_values, cell.row)
             if len(row_data) < 18 or row_data[17] == "TRUE":  # notified
                 continue
             user_id = int(row_data[2])  # user_id
@@ -730,114 +1313,204 @@ async def check_order_status(context: ContextTypes.DEFAULT_TYPE):
                 "shipped": f"🚚 سفارش شما (#{order_id}) ارسال شد!\nIl tuo ordine (#{order_id}) è stato spedito!"
             }[status]
             await context.bot.send_message(user_id, msg, reply_markup=await kb_main(context))
-            await asyncio.to_thread(orders_ws.update_cell, cell.row, 18, "TRUE")
+            await run_sheets(orders_ws.update_cell, cell.row, 18, "TRUE")
             log.info(f"Sent {status} notification for order {order_id} to user {user_id}")
         check_order_status._last_checked_row = max(last_checked_row, max((c.row for c in shipped_cells + preparing_cells), default=1))
     except Exception as e:
         log.error(f"Error checking order status: {e}")
-        if ADMIN_ID and bot:
-            await bot.send_message(ADMIN_ID, f"⚠️ خطا در بررسی وضعیت سفارشات: {e}")
+        notify_admin(f"⚠️ خطا در بررسی وضعیت سفارشات: {e}")
 
 # ───────────── Backup Google Sheets
 async def backup_sheets(context: ContextTypes.DEFAULT_TYPE):
     try:
         sheets = [orders_ws, products_ws, discounts_ws, abandoned_cart_ws, uploads_ws]
+        today = dt.datetime.now(dt.UTC).date()
         for sheet in sheets:
-            records = await asyncio.to_thread(sheet.get_all_values)
+            records = await run_sheets(sheet.get_all_values)
             csv_content = "\n".join([",".join(row) for row in records])
             csv_file = io.BytesIO(csv_content.encode("utf-8"))
-            csv_file.name = f"{sheet.title}_backup_{dt.datetime.utcnow().strftime('%Y%m%d')}.csv"
-            await context.bot.send_document(ADMIN_ID, document=csv_file, caption=f"📊 بکاپ {sheet.title} - {dt.datetime.utcnow().strftime('%Y-%m-%d')}")
+            csv_file.name = f"{sheet.title}_backup_{today:%Y%m%d}.csv"
+            await context.bot.send_document(ADMIN_ID, document=csv_file, caption=f"📊 بکاپ {sheet.title} - {today:%Y-%m-%d}")
             log.info(f"Backup sent for {sheet.title}")
     except Exception as e:
         log.error(f"Error creating backup: {e}")
-        if ADMIN_ID and bot:
-            await bot.send_message(ADMIN_ID, f"⚠️ خطا در ایجاد بکاپ: {e}")
+        notify_admin(f"⚠️ خطا در ایجاد بکاپ: {e}")
 
 # ───────────── Abandoned Cart Reminder
 async def send_cart_reminder(context: ContextTypes.DEFAULT_TYPE):
     try:
-        records = await asyncio.to_thread(abandoned_cart_ws.get_all_records)
+        records = await run_sheets(abandoned_cart_ws.get_all_records)
         for record in records:
-            cart = json.loads(record["cart"])
+            cart = as_cart(orjson.loads(record["cart"]))
             user_id = int(record["user_id"])
             if cart:
                 await context.bot.send_message(
                     user_id,
                     f"🛒 سبد خرید شما هنوز منتظر شماست!\nHai lasciato qualcosa nel carrello!\n{fmt_cart(cart)}\n👉 برای تکمیل سفارش: /start",
-                    reply_markup=await kb_main(context)
+                    reply_markup=await kb_main(context),
+                    parse_mode="HTML"
                 )
-        await asyncio.to_thread(abandoned_cart_ws.clear)
+        await run_sheets(abandoned_cart_ws.clear)
     except Exception as e:
         log.error(f"Error sending cart reminders: {e}")
-        if ADMIN_ID and bot:
-            await bot.send_message(ADMIN_ID, f"⚠️ خطا در ارسال یادآور سبد خرید: {e}")
+        notify_admin(f"⚠️ خطا در ارسال یادآور سبد خرید: {e}")
 
 # ───────────── /search
-from difflib import get_close_matches
 async def cmd_search(u, ctx: ContextTypes.DEFAULT_TYPE):
     try:
         q = " ".join(ctx.args).lower()
         if not q:
             await u.message.reply_text(m("SEARCH_USAGE"))
             return
-        hits = [(pid, p) for pid, p in (await get_products()).items()
-                if q in p['fa'].lower() or q in p['it'].lower()
-                or get_close_matches(q, [p['fa'].lower() + " " + p['it'].lower()], cutoff=0.6)]
+        prods = await get_products()
+        # Exact substring hits first; fuzzy matching only tops up the remaining slots
+        hits = substring_hits(q, 5)
+        if len(hits) < 5:
+            hits += [idx for _, _, idx in process.extract(q, SEARCH_HAYSTACK, scorer=fuzz.WRatio, limit=5, score_cutoff=60)
+                     if idx not in hits][:5 - len(hits)]
         if not hits:
             await u.message.reply_text(m("SEARCH_NONE"))
             return
-        for pid, p in hits[:5]:
-            cap = f"{p['fa']} / {p['it']}\n{p['desc']}\n{p['price']}€\nموجودی / Stock: {p['stock']}"
-            btn = InlineKeyboardMarkup.from_button(InlineKeyboardButton(m("CART_ADDED").split("\n")[0], callback_data=f"add_{pid}"))
-            if p["image_url"] and p["image_url"].strip():
-                await u.message.reply_photo(p["image_url"], caption=cap, reply_markup=btn)
+        for idx in hits:
+            pid = SEARCH_KEYS[idx]
+            p = prods[pid]
+            cap = SEARCH_CAP[pid] + str(p.stock)
+            if p.image_url:
+                await send_product_photo(u.message.reply_photo, ctx, p.image_url,
+                                         caption=cap, reply_markup=SEARCH_KB[pid], parse_mode="HTML")
             else:
-                await u.message.reply_text(cap, reply_markup=btn)
+                await u.message.reply_text(cap, reply_markup=SEARCH_KB[pid], parse_mode="HTML")
     except Exception as e:
         log.error(f"Error in cmd_search: {e}")
         await u.message.reply_text("❗️ خطا در جستجو. لطفاً دوباره امتحان کنید.")
-        if ADMIN_ID and bot:
-            await bot.send_message(ADMIN_ID, f"⚠️ خطا در /search: {e}")
+        notify_admin(f"⚠️ خطا در /search: {e}")
 
 # ───────────── Commands
 async def cmd_start(u, ctx: ContextTypes.DEFAULT_TYPE):
     try:
         ctx.user_data["user_id"] = u.effective_user.id
-        await u.message.reply_html(m("WELCOME"), reply_markup=await kb_main(ctx))
+        await u.message.reply_html(WELCOME_HTML, reply_markup=await kb_main(ctx))
     except Exception as e:
         log.error(f"Error in cmd_start: {e}")
         await u.message.reply_text("❗️ خطایی در بارگذاری منو رخ داد. لطفاً بعداً امتحان کنید یا با پشتیبانی تماس بگیرید.\nErrore nel caricamento del menu. Riprova più tardi o contatta il supporto.")
-        if ADMIN_ID and bot:
-            await bot.send_message(ADMIN_ID, f"⚠️ خطا در /start: {e}")
+        notify_admin(f"⚠️ خطا در /start: {e}")
         raise
 
+# Static pages are sent once to the admin chat at startup; handlers copy that message
+# server-side instead of uploading the full bilingual text on every request. Only with durable
+# state (see DURABLE_STATE): otherwise every deploy would re-post them, and the text is sent directly
+STATIC_PAGES = {"about": ABOUT_TEXT, "privacy": PRIVACY_TEXT}
+
+async def archive_static_pages(app: Application):
+    pages = app.bot_data.setdefault("static_pages", {})
+    for key, text in STATIC_PAGES.items():
+        if pages.get(key, {}).get("text") == text:
+            continue
+        msg = await app.bot.send_message(ADMIN_ID, text, disable_notification=True, disable_web_page_preview=True)
+        pages[key] = {"text": text, "message_id": msg.message_id}
+
+async def send_static_page(u, ctx: ContextTypes.DEFAULT_TYPE, key):
+    pages = ctx.bot_data.get("static_pages", {})
+    if (page := pages.get(key)) and page["text"] == STATIC_PAGES[key]:
+        try:
+            await ctx.bot.copy_message(u.effective_chat.id, ADMIN_ID, page["message_id"])
+            return
+        except BadRequest as e:
+            log.error(f"Archived '{key}' page unavailable, sending text: {e}")
+            pages.pop(key, None)
+    await u.message.reply_text(STATIC_PAGES[key], disable_web_page_preview=True)
+
 async def cmd_about(u, ctx: ContextTypes.DEFAULT_TYPE):
     try:
-        await u.message.reply_text(m("ABOUT_US"), disable_web_page_preview=True)
+        await send_static_page(u, ctx, "about")
     except Exception as e:
         log.error(f"Error in cmd_about: {e}")
         await u.message.reply_text("❗️ خطا در نمایش اطلاعات. لطفاً دوباره امتحان کنید.")
 
 async def cmd_privacy(u, ctx: ContextTypes.DEFAULT_TYPE):
     try:
-        await u.message.reply_text(m("PRIVACY"), disable_web_page_preview=True)
+        await send_static_page(u, ctx, "privacy")
     except Exception as e:
         log.error(f"Error in cmd_privacy: {e}")
         await u.message.reply_text("❗️ خطا در نمایش سیاست حریم خصوصی. لطفاً دوباره امتحان کنید.")
 
+# Images without a cached file_id are sent to the admin chat once (silently, then deleted);
+# ctx is anything with .bot and .bot_data, so the Application itself works at startup.
+# If Telegram can't fetch a URL itself (host blocks it, image too big for URL uploads),
+# the image is downloaded here and uploaded as a file instead
+async def warm_photo_ids(ctx):
+    ids = ctx.bot_data.setdefault("photo_ids", {})
+    urls = {p.image_url for p in (await get_products()).values() if p.image_url} - ids.keys()
+    async with httpx.AsyncClient(http2=True, timeout=20, follow_redirects=True) as client:
+        for url in urls:
+            try:
+                try:
+                    msg = await send_product_photo(ctx.bot.send_photo, ctx, url, chat_id=ADMIN_ID,
+                                                   disable_notification=True)
+                except BadRequest as e:
+                    log.error(f"Telegram could not fetch {url}, uploading it instead: {e}")
+                    res = await client.get(url)
+                    res.raise_for_status()
+                    msg = await ctx.bot.send_photo(ADMIN_ID, photo=res.content, disable_notification=True)
+                    ids[url] = msg.photo[-1].file_id
+                await msg.delete()
+            except Exception as e:
+                log.error(f"Warmup failed for {url}: {e}")
+    return len(urls & ids.keys()), len(urls)
+
+async def cmd_warmup(u, ctx: ContextTypes.DEFAULT_TYPE):
+    # Admin only: send every product image once so later views reuse cached file_ids
+    if u.effective_user.id != ADMIN_ID:
+        return
+    try:
+        cached, total = await warm_photo_ids(ctx)
+        await u.message.reply_text(f"✅ {cached}/{total} تصویر در کش ذخیره شد.")
+    except Exception as e:
+        log.error(f"Error in cmd_warmup: {e}")
+        await u.message.reply_text("❗️ خطا در آماده‌سازی تصاویر.")
+
+# One CommandHandler parses the command once per message; the name then picks the callback
+COMMANDS = {
+    "start": cmd_start,
+    "search": cmd_search,
+    "about": cmd_about,
+    "privacy": cmd_privacy,
+    "warmup": cmd_warmup,
+}
+
+async def cmd_router(u, ctx: ContextTypes.DEFAULT_TYPE):
+    name = u.effective_message.text[1:].split(maxsplit=1)[0].partition("@")[0].lower()
+    await COMMANDS[name](u, ctx)
+
 # ───────────── App, webhook and FastAPI
+BOT_COMMANDS = [
+    BotCommand("start", "🏠 منوی اصلی / Menu"),
+    BotCommand("search", "🔍 جستجو / Cerca"),
+    BotCommand("about", "👋 درباره ما / Chi siamo"),
+    BotCommand("privacy", "🔒 حریم خصوصی / Privacy"),
+    BotCommand("cancel", "❌ لغو سفارش / Annulla ordine"),
+]
+
 async def post_init(app: Application):
     try:
         log.info("Application initialized")
         webhook_url = f"{BASE_URL}/webhook/{WEBHOOK_SECRET}"
-        await app.bot.set_webhook(webhook_url)
+        # Updates are acked before processing, so Telegram may keep more deliveries in flight;
+        # update types no handler uses (edits, chat member changes, ...) are not delivered at all
+        await app.bot.set_webhook(webhook_url, max_connections=WEBHOOK_CONNECTIONS,
+                                  allowed_updates=WEBHOOK_UPDATES)
         log.info(f"Webhook set to {webhook_url}")
+        # Command menu is global to the bot, so it is set once per deployment, not per /start
+        await app.bot.set_my_commands(BOT_COMMANDS)
     except Exception as e:
         log.error(f"Failed to set webhook: {e}")
-        if ADMIN_ID and bot:
-            await bot.send_message(ADMIN_ID, f"⚠️ خطا در تنظیم Webhook: {e}")
+        notify_admin(f"⚠️ خطا در تنظیم Webhook: {e}")
         raise
+    if DURABLE_STATE:
+        try:
+            await archive_static_pages(app)
+        except Exception as e:
+            log.error(f"Failed to archive static pages: {e}")
 
 async def post_shutdown(app: Application):
     log.info("Application shutting down")
@@ -846,39 +1519,264 @@ async def post_shutdown(app: Application):
     except Exception as e:
         log.error(f"Failed to delete webhook: {e}")
 
+WEBHOOK_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100"))    # Telegram accepts 1-100
+WEBHOOK_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+STATE_FILE = os.getenv("STATE_FILE", "/tmp/bazarino_state.pkl")
+REDIS_URL = os.getenv("REDIS_URL")
+# False when a redeploy wipes carts, forms and bot_data["photo_ids"] (see build_app)
+DURABLE_STATE = bool(REDIS_URL) or not on_ephemeral_disk(STATE_FILE)
+REDIS_TTL = int(os.getenv("REDIS_TTL", str(7 * 86400)))    # idle sessions (carts, half-filled forms) expire
+# Every callback query is tested against the checkout entry point first; a plain equality check beats a regex
+CHECKOUT_PATTERN = "checkout".__eq__
+
+BOT_API_KEEPALIVE = 90
+BOT_API_POOL = int(os.getenv("BOT_API_POOL_SIZE", "32"))
+
+# Set by OrjsonRequest.do_request for the current task; the client sends it instead of form fields
+_JSON_BODY: contextvars.ContextVar[bytes | None] = contextvars.ContextVar("_JSON_BODY", default=None)
+
+class JsonBodyClient(httpx.AsyncClient):
+    async def request(self, method, url, *, data=None, headers=None, **kwargs):
+        if (body := _JSON_BODY.get()) is None:
+            return await super().request(method, url, data=data, headers=headers, **kwargs)
+        return await super().request(method, url, content=body,
+                                     headers={**(headers or {}), "Content-Type": "application/json"}, **kwargs)
+
+class OrjsonRequest(HTTPXRequest):
+    def _build_client(self):
+        # httpx drops idle connections after 5s; a quiet shop would then pay a fresh TLS handshake
+        # to api.telegram.org on most replies, so idle connections are kept for BOT_API_KEEPALIVE
+        limits = self._client_kwargs["limits"]
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=BOT_API_KEEPALIVE)
+        return JsonBodyClient(**self._client_kwargs)
+
+    # The Bot API accepts JSON bodies: orjson encodes them faster than the stdlib and sends
+    # Persian text as raw UTF-8 instead of percent-encoded form fields. Uploads stay multipart.
+    # Only the body changes; timeouts, checks and error mapping are PTB's own do_request
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        body = None if request_data is None or request_data.contains_files else orjson.dumps(request_data.parameters)
+        token = _JSON_BODY.set(body)
+        try:
+            return await super().do_request(url, method, request_data, **kwargs)
+        finally:
+            _JSON_BODY.reset(token)
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Updates from different chats run concurrently; updates from one chat run one at a time in
+    # arrival order, so the order conversation never handles two steps of the same user at once.
+    # An update waits for its chat's lock before taking one of the max_concurrent_updates slots, so a
+    # burst from one chat queues on its own lock instead of occupying slots other chats need
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}    # chat id -> [lock, number of updates holding or waiting for it]
+
+    async def process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class RedisPersistence(BasePersistence):
+    # Used instead of the pickle file when REDIS_URL is set: each user's data is its own key, loaded on
+    # the user's first update in this process rather than all at startup, and survives restarts/redeploys.
+    # A user's key is read only while their in-memory copy is empty, so writes made by another
+    # instance are not picked up: run one bot process per Redis prefix
+    LOADED_MAX = 4096
+    def __init__(self, url: str, prefix: str = "bazarino"):
+        super().__init__(store_data=PersistenceInput(chat_data=False, callback_data=False), update_interval=5)
+        self.redis = aioredis.Redis.from_url(url)
+        self.prefix = prefix
+        self._loaded: Dict[int, None] = {}    # most recently seen users last, at most LOADED_MAX
+
+    def _key(self, *parts) -> str:
+        return ":".join((self.prefix, *map(str, parts)))
+
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Only the first time: afterwards the in-memory copy is newer than what was last written.
+        # Users idle long enough to be evicted are checked again, but only an empty copy is replaced
+        known = user_id in self._loaded
+        self._loaded.pop(user_id, None)
+        self._loaded[user_id] = None
+        if known:
+            return
+        if len(self._loaded) > self.LOADED_MAX:
+            del self._loaded[next(iter(self._loaded))]
+        if not user_data and (raw := await self.redis.get(self._key("user", user_id))):
+            user_data.update(pickle.loads(raw))
+
+    async def update_user_data(self, user_id, data):
+        if data:
+            await self.redis.set(self._key("user", user_id), pickle.dumps(data), ex=REDIS_TTL)
+        else:
+            await self.redis.delete(self._key("user", user_id))
+
+    async def drop_user_data(self, user_id):
+        await self.redis.delete(self._key("user", user_id))
+
+    async def get_bot_data(self):
+        raw = await self.redis.get(self._key("bot"))
+        return pickle.loads(raw) if raw else {}
+
+    async def update_bot_data(self, data):
+        await self.redis.set(self._key("bot"), pickle.dumps(data))
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_conversations(self, name):
+        raw = await self.redis.hgetall(self._key("conv", name))
+        return {tuple(orjson.loads(k)): pickle.loads(v) for k, v in raw.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        conv = self._key("conv", name)
+        if new_state is None:
+            await self.redis.hdel(conv, orjson.dumps(key))
+        else:
+            await self.redis.hset(conv, orjson.dumps(key), pickle.dumps(new_state))
+            await self.redis.expire(conv, REDIS_TTL)
+
+    # chat_data and callback_data are not stored (see store_data)
+    async def get_chat_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def flush(self):
+        await self.redis.aclose()
+
+MAX_CONCURRENT_UPDATES = 256
+# Telegram allows ~30 messages/s per bot and 20 messages/min per group (ADMIN_CHAT_ID may be one);
+# staying just under both avoids 429s, and a 429 that does happen is retried after its retry_after
+RATE_LIMITER = dict(overall_max_rate=28, overall_time_period=1,
+                    group_max_rate=18, group_time_period=60, max_retries=3)
+
+# Handlers registered by build_app(); checked at startup so a duplicate or lost registration fails loudly
+HANDLER_COUNT = 4
+
+def build_app() -> Application:
+    # Carts, order-form state and photo file_ids outlive a process restart, and a redeploy only if
+    # they are in Redis or STATE_FILE is on a mounted disk. The pickle file is rewritten whole on the
+    # event loop, so PTB batches those writes every update_interval seconds
+    if not DURABLE_STATE:
+        log.warning(f"STATE_FILE {STATE_FILE} is on an ephemeral disk: carts, order forms and photo "
+                    f"file_ids are lost on every redeploy; set REDIS_URL or point STATE_FILE at a persistent disk")
+    persistence = RedisPersistence(REDIS_URL) if REDIS_URL else PicklePersistence(
+        filepath=STATE_FILE, update_interval=60,
+        store_data=PersistenceInput(chat_data=False, callback_data=False))
+    # HTTP/2 lets concurrent sends (e.g. customer and admin invoices) share one multiplexed connection.
+    # If HTTP/2 is not negotiated each send needs its own connection, so the pool is sized for bursts
+    # and a send waits a few seconds for a free connection instead of failing the reply after 1s
+    request = OrjsonRequest(http_version="2", connection_pool_size=BOT_API_POOL, read_timeout=20,
+                            connect_timeout=5.0, pool_timeout=5.0)
+    application = (ApplicationBuilder().token(TOKEN).persistence(persistence)
+                   .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+                   .request(request).rate_limiter(AIORateLimiter(**RATE_LIMITER))
+                   .post_init(post_init).post_shutdown(post_shutdown).build())
+    job_queue = application.job_queue
+    if job_queue is None:
+        raise SystemExit("❗️ JobQueue در دسترس نیست؛ python-telegram-bot[job-queue] را نصب کنید.")
+    job_queue.run_daily(send_cart_reminder, time=dt.time(hour=18, minute=0))
+    job_queue.run_repeating(check_order_status, interval=600)
+    job_queue.run_daily(backup_sheets, time=dt.time(hour=0, minute=0))
+    job_queue.run_repeating(refresh_products_job, interval=PRODUCTS_CHECK, first=PRODUCTS_CHECK)
+    job_queue.run_repeating(flush_orders_job, interval=ORDERS_FLUSH, first=ORDERS_FLUSH)
+    application.add_handlers([
+        CommandHandler(COMMANDS.keys(), cmd_router),
+        MessageHandler(filters.PHOTO, handle_photo),
+        ConversationHandler(
+            entry_points=[CallbackQueryHandler(start_order, pattern=CHECKOUT_PATTERN)],
+            states={
+                **{state: [MessageHandler(TEXT_INPUT, functools.partial(form_step, state))]
+                   for state in FORM_STEPS},
+                ASK_DISCOUNT: [MessageHandler(SKIP_INPUT, ask_notes)],
+                ASK_NOTES: [MessageHandler(SKIP_INPUT, confirm_order)],
+                ConversationHandler.TIMEOUT: [TypeHandler(Update, order_timeout)],
+            },
+            fallbacks=[CommandHandler("cancel", cancel_order)],
+            conversation_timeout=ORDER_TIMEOUT,
+            name="order",
+            persistent=True,
+        ),
+        CallbackQueryHandler(router),
+    ])
+    registered = sum(len(h) for h in application.handlers.values())
+    if registered != HANDLER_COUNT:
+        raise RuntimeError(f"Expected {HANDLER_COUNT} handlers, {registered} registered")
+    return application
+
+async def warm_products():
+    try:
+        await get_products()
+    except (Exception, SystemExit) as e:
+        log.error(f"Product warm-up failed, loading on first use: {e}")
+
 async def lifespan(app: FastAPI):
     global tg_app, bot
     try:
-        builder = ApplicationBuilder().token(TOKEN).post_init(post_init).post_shutdown(post_shutdown)
-        tg_app = builder.build()
+        tg_app = build_app()
         bot = tg_app.bot
+        # The catalogue (snapshot or sheet) loads while the Bot API calls below are in flight,
+        # so a cold boot waits for the slower of the two and the first user finds menus ready
+        warmup = asyncio.create_task(warm_products())
         await tg_app.initialize()
-        if not tg_app.job_queue:
-            tg_app.job_queue = JobQueue()
-            await tg_app.job_queue.start()
-        job_queue = tg_app.job_queue
-        job_queue.run_daily(send_cart_reminder, time=dt.time(hour=18, minute=0))
-        job_queue.run_repeating(check_order_status, interval=600)
-        job_queue.run_daily(backup_sheets, time=dt.time(hour=0, minute=0))
-        tg_app.add_handler(CommandHandler("start", cmd_start))
-        tg_app.add_handler(CommandHandler("search", cmd_search))
-        tg_app.add_handler(CommandHandler("about", cmd_about))
-        tg_app.add_handler(CommandHandler("privacy", cmd_privacy))
-        tg_app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-        tg_app.add_handler(ConversationHandler(
-            entry_points=[CallbackQueryHandler(start_order, pattern="^checkout$")],
-            states={
-                ASK_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_phone)],
-                ASK_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_address)],
-                ASK_ADDRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_postal)],
-                ASK_POSTAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_discount)],
-                ASK_DISCOUNT: [MessageHandler(filters.TEXT | filters.COMMAND, ask_notes)],
-                ASK_NOTES: [MessageHandler(filters.TEXT | filters.COMMAND, confirm_order)],
-            },
-            fallbacks=[CommandHandler("cancel", cancel_order)]
-        ))
-        tg_app.add_handler(CallbackQueryHandler(router))
+        # uvicorn drives the lifecycle instead of run_webhook(), so post_init is invoked here
+        await tg_app.post_init(tg_app)
+        await tg_app.start()
+        await warmup
+        if on_ephemeral_disk(ORDERS_DB):
+            notify_admin(f"⚠️ ORDERS_DB ({ORDERS_DB}) روی دیسک موقت است؛ سفارش‌های ثبت‌نشده با هر استقرار "
+                         f"پاک می‌شوند. ORDERS_DB را روی دیسک دائمی تنظیم کنید.")
+        # New product images get their file_id before the first customer opens them. Only with durable
+        # state: otherwise photo_ids start empty after every deploy and the whole catalogue would be
+        # re-sent to the admin chat; /warmup stays available by hand
+        if ADMIN_ID and DURABLE_STATE:
+            run_background(best_effort(warm_photo_ids(tg_app), "Photo warm-up"))
         yield
+        await tg_app.stop()
+        await flush_orders()
+        await flush_cart_snapshots()
+        if (left := pending_orders()) and on_ephemeral_disk(ORDERS_DB) and ADMIN_ID:
+            await export_pending_orders()
+        elif left:
+            log.info(f"{left} orders not yet in Google Sheets stay in {ORDERS_DB} for the next start")
+        await SHEETS_HTTP.aclose()
         await tg_app.shutdown()
     except Exception as e:
         log.error(f"Error in lifespan: {e}")
@@ -893,143 +1791,169 @@ async def keep_alive():
     return {"status": "Bazarino is alive 🚀"}
 
 
+# Telegram redelivers an update whose 200 it did not see (e.g. a proxy timeout); the latest update_ids
+# are remembered so a redelivered order step is not processed twice. The set lives in memory only, so
+# this covers redeliveries within one process lifetime, not across a restart
+SEEN_UPDATES: Dict[int, None] = {}
+SEEN_UPDATES_MAX = 2048
+
 @app.post("/webhook/{secret}")
 async def wh(req: Request, secret: str):
     try:
         if secret != WEBHOOK_SECRET:
             log.error("Invalid webhook secret")
             raise HTTPException(status_code=403, detail="Invalid secret")
-        data = await req.json()
-        update = Update.de_json(data, bot)
+        update = Update.de_json(orjson.loads(await req.body()), bot)
         if not update:
             log.error("Invalid webhook update received")
             raise HTTPException(status_code=400, detail="Invalid update")
-        await tg_app.process_update(update)
+        if update.update_id in SEEN_UPDATES:
+            log.info(f"Ignoring redelivered update {update.update_id}")
+            return {"ok": True}
+        SEEN_UPDATES[update.update_id] = None
+        if len(SEEN_UPDATES) > SEEN_UPDATES_MAX:
+            del SEEN_UPDATES[next(iter(SEEN_UPDATES))]
+        # Ack right away; the application started in lifespan dispatches from update_queue,
+        # so slow handlers never hold Telegram's request open
+        await tg_app.update_queue.put(update)
         return {"ok": True}
+    except HTTPException:
+        raise
     except Exception as e:
         log.error(f"Webhook error: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
-async def router(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    try:
-        q = update.callback_query
-        d = q.data
-        await q.answer()
-
-        if d == "back":
-            await safe_edit(q, m("WELCOME"), reply_markup=await kb_main(ctx), parse_mode="HTML")
-            return
-
-        if d == "support":
-            await safe_edit(q, m("SUPPORT_MESSAGE"), reply_markup=kb_support(), parse_mode="HTML")
-            return
-
-        if d == "upload_photo":
-            ctx.user_data["awaiting_photo"] = True
-            await safe_edit(q, m("UPLOAD_PHOTO"), reply_markup=kb_support())
-            return
-
-        if d == "bestsellers":
-            bestsellers = [(pid, p) for pid, p in (await get_products()).items() if p.get("is_bestseller", False)]
-            if not bestsellers:
-                await safe_edit(q, "🔥 در حال حاضر محصول پرفروشی وجود ندارد.\nNessun prodotto più venduto al momento.", reply_markup=await kb_main(ctx), parse_mode="HTML")
-                return
-            rows = [[InlineKeyboardButton(f"{p['fa']} / {p['it']}", callback_data=f"show_{pid}")] for pid, p in bestsellers]
-            rows.append([InlineKeyboardButton(m("BTN_BACK"), callback_data="back")])
-            await safe_edit(q, "🔥 محصولات پرفروش / Più venduti", reply_markup=InlineKeyboardMarkup(rows), parse_mode="HTML")
-            return
-
-        if d == "search":
-            await safe_edit(q, m("SEARCH_USAGE"), reply_markup=await kb_main(ctx))
-            return
-
-        if d.startswith("cat_"):
-            cat = d[4:]
-            await safe_edit(q, EMOJI.get(cat, cat), reply_markup=await kb_category(cat, ctx), parse_mode="HTML")
-            return
-
-        if d.startswith("show_"):
-            pid = d[5:]
-            p = (await get_products())[pid]
-            cap = f"<b>{p['fa']} / {p['it']}</b>\n{p['desc']}\n{p['price']}€ / {p['weight']}\n||موجودی / Stock:|| {p['stock']}"
-            try:
-                await q.message.delete()
-            except Exception as e:
-                log.error(f"Error deleting previous message: {e}")
-            if p["image_url"] and p["image_url"].strip():
-                await ctx.bot.send_photo(
-                    chat_id=q.message.chat.id,
-                    photo=p["image_url"],
-                    caption=cap,
-                    reply_markup=kb_product(pid),
-                    parse_mode="HTML"
-                )
-            else:
-                await ctx.bot.send_message(
-                    chat_id=q.message.chat.id,
-                    text=cap,
-                    reply_markup=kb_product(pid),
-                    parse_mode="HTML"
-                )
-            return
-
-        if d.startswith("add_"):
-            pid = d[4:]
-            ok, msg = await add_cart(ctx, pid, qty=1, update=update)
-            await q.answer(msg, show_alert=not ok)
-            cat = (await get_products())[pid]["cat"]
-            await safe_edit(q, EMOJI.get(cat, cat), reply_markup=await kb_category(cat, ctx), parse_mode="HTML")
-            return
+# Callback handlers, dispatched by the prefix before the first "_" in callback_data
+async def cb_add(update: Update, ctx: ContextTypes.DEFAULT_TYPE, pid: str):
+    ok, msg = await add_cart(ctx, pid, qty=1, update=update)
+    await update.callback_query.answer(msg, show_alert=not ok)
 
-        if d.startswith("back_cat_"):
-            cat = d.split("_")[2]
-            await safe_edit(q, EMOJI.get(cat, cat), reply_markup=await kb_category(cat, ctx), parse_mode="HTML")
-            return
+async def cb_destination(update: Update, ctx: ContextTypes.DEFAULT_TYPE, arg: str):
+    q = update.callback_query
+    if dest := DESTINATIONS.get(q.data):
+        ctx.user_data["dest"] = dest
+        await q.answer(f"✅ {dest}")
+    else:
+        await q.answer()
 
-        if d == "cart":
-            cart = ctx.user_data.get("cart", [])
-            await safe_edit(q, f"{m('CART_GUIDE')}\n\n{fmt_cart(cart)}", reply_markup=kb_cart(cart), parse_mode="HTML")
+async def cb_cart_edit(update: Update, ctx: ContextTypes.DEFAULT_TYPE, pid: str):
+    q = update.callback_query
+    op = q.data[:3]
+    cart = get_cart(ctx)
+    it = cart.get(pid)
+    if not it or (op == "dec" and it.qty <= 1):
+        await q.answer()
+        return
+    if op == "inc":
+        ok, msg = await add_cart(ctx, pid, 1, update=update)
+        if not ok:
+            await q.answer(msg, show_alert=True)
             return
+    else:
+        if op == "dec":
+            it.qty -= 1
+        else:
+            del cart[pid]
+        snapshot_cart(ctx.user_data.get("user_id", update.effective_user.id), cart)
+    run_background(answer_quietly(q))
+    await safe_edit(q, CART_GUIDE_HTML + fmt_cart(cart), reply_markup=kb_cart(cart), parse_mode="HTML")
+
+async def cb_back(update: Update, ctx: ContextTypes.DEFAULT_TYPE, arg: str):
+    # back_cat_<cat> comes from product messages sent before they linked to cat_<cat> directly
+    if arg.startswith("cat_"):
+        await cb_category(update, ctx, arg[4:])
+        return
+    await safe_edit(update.callback_query, WELCOME_HTML, reply_markup=await kb_main(ctx), parse_mode="HTML")
+
+async def cb_support(update: Update, ctx: ContextTypes.DEFAULT_TYPE, arg: str):
+    await safe_edit(update.callback_query, SUPPORT_HTML, reply_markup=kb_support(), parse_mode="HTML")
+
+async def cb_upload_photo(update: Update, ctx: ContextTypes.DEFAULT_TYPE, arg: str):
+    ctx.user_data["awaiting_photo"] = True
+    await safe_edit(update.callback_query, m("UPLOAD_PHOTO"), reply_markup=kb_support())
+
+async def cb_bestsellers(update: Update, ctx: ContextTypes.DEFAULT_TYPE, arg: str):
+    q = update.callback_query
+    await get_products()
+    if not BESTSELLER_KB:
+        await safe_edit(q, "🔥 در حال حاضر محصول پرفروشی وجود ندارد.\nNessun prodotto più venduto al momento.", reply_markup=await kb_main(ctx), parse_mode="HTML")
+        return
+    await safe_edit(q, "🔥 محصولات پرفروش / Più venduti", reply_markup=BESTSELLER_KB, parse_mode="HTML")
+
+async def cb_search(update: Update, ctx: ContextTypes.DEFAULT_TYPE, arg: str):
+    await safe_edit(update.callback_query, m("SEARCH_USAGE"), reply_markup=await kb_main(ctx))
+
+async def cb_category(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cat: str):
+    await safe_edit(update.callback_query, EMOJI.get(cat, cat), reply_markup=await kb_category(cat), parse_mode="HTML")
+
+async def cb_show(update: Update, ctx: ContextTypes.DEFAULT_TYPE, pid: str):
+    q = update.callback_query
+    p = (await get_products())[pid]
+    cap = PRODUCT_CAP[pid] + str(p.stock)
+    run_background(delete_quietly(q.message))
+    if p.image_url:
+        await send_product_photo(
+            ctx.bot.send_photo, ctx, p.image_url,
+            chat_id=q.message.chat.id,
+            caption=cap,
+            reply_markup=kb_product(pid),
+            parse_mode="HTML"
+        )
+    else:
+        await ctx.bot.send_message(
+            chat_id=q.message.chat.id,
+            text=cap,
+            reply_markup=kb_product(pid),
+            parse_mode="HTML"
+        )
+
+async def cb_cart(update: Update, ctx: ContextTypes.DEFAULT_TYPE, arg: str):
+    cart = get_cart(ctx)
+    await safe_edit(update.callback_query, CART_GUIDE_HTML + fmt_cart(cart), reply_markup=kb_cart(cart), parse_mode="HTML")
+
+async def cb_checkout(update: Update, ctx: ContextTypes.DEFAULT_TYPE, arg: str):
+    return await start_order(update, ctx)
+
+# Callbacks that only need a toast answer the query themselves and skip the generic ack
+TOAST_ROUTES = {
+    "add": cb_add, "order": cb_destination,
+    "inc": cb_cart_edit, "dec": cb_cart_edit, "del": cb_cart_edit,
+}
+ROUTES = {
+    "back": cb_back, "support": cb_support, "upload": cb_upload_photo,
+    "bestsellers": cb_bestsellers, "search": cb_search, "cat": cb_category,
+    "show": cb_show, "cart": cb_cart, "checkout": cb_checkout,
+}
 
-        if d.startswith(("inc_", "dec_", "del_")):
-            pid = d.split("_")[1]
-            cart = ctx.user_data.get("cart", [])
-            it = next((i for i in cart if i["id"] == pid), None)
-            if not it:
-                return
-            if d.startswith("inc_"):
-                await add_cart(ctx, pid, 1, update=update)
-            elif d.startswith("dec_"):
-                it["qty"] = max(1, it["qty"] - 1)
-            else:
-                cart.remove(it)
-            try:
-                await asyncio.to_thread(
-                    abandoned_cart_ws.append_row,
-                    [dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                     ctx.user_data.get("user_id", update.effective_user.id),
-                     json.dumps(cart)]
-                )
-            except Exception as e:
-                log.error(f"Error saving abandoned cart: {e}")
-            await safe_edit(q, f"{m('CART_GUIDE')}\n\n{fmt_cart(cart)}", reply_markup=kb_cart(cart), parse_mode="HTML")
-            return
+# Navigation taps repeated within DOUBLE_TAP seconds (same user, same button) are acked but not
+# re-rendered, so button mashing doesn't spend the bot's outgoing rate budget; cart edits are exempt.
+# The last tap is kept in user_data["last_tap"] with wall-clock time, so a stamp restored by
+# persistence after a restart is still comparable
+DOUBLE_TAP = 0.5
 
-        if d in ["order_perugia", "order_italy"]:
-            ctx.user_data["dest"] = "Perugia" if d == "order_perugia" else "Italy"
-            await safe_edit(q, f"{m('CART_GUIDE')}\n\n{fmt_cart(ctx.user_data.get('cart', []))}", reply_markup=kb_cart(ctx.user_data.get("cart", [])), parse_mode="HTML")
+async def router(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    try:
+        q = update.callback_query
+        # data is None for callbacks the bot never attached (e.g. game buttons); those just get acked
+        prefix, _, arg = (q.data or "").partition("_")
+        if handler := TOAST_ROUTES.get(prefix):
+            return await handler(update, ctx, arg)
+        # Plain acks run concurrently with the edit instead of costing a round-trip up front
+        run_background(answer_quietly(q))
+        now = time.time()
+        last = ctx.user_data.get("last_tap")
+        ctx.user_data["last_tap"] = (q.data, now)
+        if last and last[0] == q.data and now - last[1] < DOUBLE_TAP:
             return
-
-        if d == "checkout":
-            return await start_order(update, ctx)
+        if handler := ROUTES.get(prefix):
+            return await handler(update, ctx, arg)
     except Exception as e:
         log.error(f"Error in router: {e}")
         await q.message.reply_text("❗️ خطا در پردازش درخواست. لطفاً دوباره امتحان کنید.")
-        if ADMIN_ID and bot:
-            await bot.send_message(ADMIN_ID, f"⚠️ خطا در router: {e}")
+        notify_admin(f"⚠️ خطا در router: {e}")
 
 def main():
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    uvicorn.run(app, host=HOST, port=PORT, loop="uvloop", timeout_keep_alive=KEEPALIVE)
 
 if __name__ == "__main__":
     main()